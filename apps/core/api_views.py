@@ -3,6 +3,7 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.filters import SearchFilter, OrderingFilter
+from django.db.models import Count
 from .models import Client, Chauffeur, Vehicule, Destination, TypeService, Tarification
 from .serializers import ClientSerializer, ChauffeurSerializer, VehiculeSerializer, DestinationSerializer, TypeServiceSerializer, TarificationSerializer
 from apps.users.permissions import IsAgent, IsAdminOrReadOnly
@@ -54,7 +55,8 @@ class ClientViewSet(ExportMixin, viewsets.ModelViewSet):
 
 
 class ChauffeurViewSet(ExportMixin, viewsets.ModelViewSet):
-    queryset = Chauffeur.objects.all()
+    # Tournee count computed in the list query instead of once per chauffeur
+    queryset = Chauffeur.objects.annotate(expedition_count=Count('tournee'))
     serializer_class = ChauffeurSerializer
     permission_classes = [IsAgent]
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-15 23:57
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='destination',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-90), django.core.validators.MaxValueValidator(90)]),
+        ),
+        migrations.AddField(
+            model_name='destination',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-180), django.core.validators.MaxValueValidator(180)]),
+        ),
+        migrations.AddField(
+            model_name='destination',
+            name='nom',
+            field=models.CharField(blank=True, help_text='Nom affiché sur les cartes', max_length=150),
+        ),
+        migrations.AddIndex(
+            model_name='destination',
+            index=models.Index(fields=['latitude', 'longitude'], include=('nom',), name='dest_ll_idx'),
+        ),
+    ]
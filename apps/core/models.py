@@ -1,6 +1,6 @@
 
 from django.db import models
-from django.core.validators import RegexValidator, MinValueValidator
+from django.core.validators import RegexValidator, MinValueValidator, MaxValueValidator
 
 class Client(models.Model):
 	nom = models.CharField(max_length=100, validators=[RegexValidator(r'^[a-zA-Z\s]+$', 'Only letters and spaces allowed.')])
@@ -81,6 +81,9 @@ class Destination(models.Model):
 	pays = models.CharField(max_length=100)
 	zone_geographique = models.CharField(max_length=100)
 	tarif_base = models.DecimalField(max_digits=8, decimal_places=2, validators=[MinValueValidator(0)])
+	nom = models.CharField(max_length=150, blank=True, help_text="Nom affiché sur les cartes")
+	latitude = models.FloatField(null=True, blank=True, validators=[MinValueValidator(-90), MaxValueValidator(90)])
+	longitude = models.FloatField(null=True, blank=True, validators=[MinValueValidator(-180), MaxValueValidator(180)])
 	created_at = models.DateTimeField(auto_now_add=True)
 	updated_at = models.DateTimeField(auto_now=True)
 	is_active = models.BooleanField(default=True)
@@ -89,6 +92,8 @@ class Destination(models.Model):
 		indexes = [
 			models.Index(fields=['ville', 'pays']),
 			models.Index(fields=['zone_geographique']),
+			# Covering index for the map queries; INCLUDE is only used on PostgreSQL
+			models.Index(fields=['latitude', 'longitude'], name='dest_ll_idx', include=['nom']),
 		]
 		ordering = ['pays', 'ville']
 
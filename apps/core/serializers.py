@@ -36,6 +36,9 @@ class ChauffeurSerializer(serializers.ModelSerializer):
         return f"{obj.nom} {obj.prenom}"
 
     def get_expedition_count(self, obj):
+        # Use the count annotated by ChauffeurViewSet when present
+        if hasattr(obj, 'expedition_count'):
+            return obj.expedition_count
         return obj.tournee_set.count()
 
     def validate_numero_permis(self, value):
@@ -63,7 +66,7 @@ class VehiculeSerializer(serializers.ModelSerializer):
 class DestinationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Destination
-        fields = ['id', 'ville', 'pays', 'zone_geographique', 'tarif_base', 'created_at', 'updated_at', 'is_active']
+        fields = ['id', 'ville', 'pays', 'zone_geographique', 'tarif_base', 'nom', 'latitude', 'longitude', 'created_at', 'updated_at', 'is_active']
         read_only_fields = ['created_at', 'updated_at']
 
 class TypeServiceSerializer(serializers.ModelSerializer):
@@ -1,12 +1,15 @@
 from celery import shared_task
 from django.utils import timezone
 from datetime import timedelta
-from django.db.models import Q
+from django.db.models import Q, Sum
 from .models import Client, Chauffeur, Vehicule
 from apps.logistics.models import Expedition, TrackingLog, Tournee
 from apps.billing.models import Facture, Paiement
 from apps.support.models import Incident, Reclamation
 
+# Rows fetched per round trip when maintenance tasks walk a table
+MAINTENANCE_CHUNK_SIZE = 500
+
 
 @shared_task
 def cleanup_old_logs():
@@ -47,7 +50,7 @@ def update_client_statistics():
     clients = Client.objects.filter(is_active=True)
 
     updated_count = 0
-    for client in clients:
+    for client in clients.iterator(chunk_size=MAINTENANCE_CHUNK_SIZE):
         # Calculate total spent
         total_spent = Expedition.objects.filter(
             client=client,
@@ -65,9 +68,8 @@ def update_client_statistics():
 
         outstanding_balance = total_invoiced - total_paid
 
-        # Update client balance
-        client.solde = outstanding_balance
-        client.save()
+        # Update client balance only, without a full save() and its post_save handlers
+        Client.objects.filter(pk=client.pk).update(solde=outstanding_balance, updated_at=timezone.now())
         updated_count += 1
 
     return f"Updated statistics for {updated_count} clients"
@@ -78,7 +80,8 @@ def deactivate_inactive_entities():
     """
     Deactivate clients, drivers, and vehicles that have been inactive for too long
     """
-    cutoff_date = timezone.now() - timedelta(days=365)  # 1 year
+    now = timezone.now()
+    cutoff_date = now - timedelta(days=365)  # 1 year
 
     # Deactivate inactive clients (no expeditions in last year)
     inactive_clients = Client.objects.filter(
@@ -87,11 +90,8 @@ def deactivate_inactive_entities():
         expedition__date_creation__gte=cutoff_date
     )
 
-    clients_deactivated = 0
-    for client in inactive_clients:
-        client.is_active = False
-        client.save()
-        clients_deactivated += 1
+    # Single UPDATE per entity type; no per-row save() or post_save handlers
+    clients_deactivated = inactive_clients.update(is_active=False, updated_at=now)
 
     # Deactivate inactive drivers (no tournees in last 6 months)
     driver_cutoff = timezone.now() - timedelta(days=180)
@@ -101,11 +101,7 @@ def deactivate_inactive_entities():
         tournee__date__gte=driver_cutoff
     )
 
-    drivers_deactivated = 0
-    for driver in inactive_drivers:
-        driver.is_active = False
-        driver.save()
-        drivers_deactivated += 1
+    drivers_deactivated = inactive_drivers.update(is_active=False, updated_at=now)
 
     # Mark vehicles as maintenance if not used recently
     vehicle_cutoff = timezone.now() - timedelta(days=30)
@@ -116,11 +112,7 @@ def deactivate_inactive_entities():
         tournee__date__gte=vehicle_cutoff
     )
 
-    vehicles_maintenance = 0
-    for vehicle in inactive_vehicles:
-        vehicle.etat = 'maintenance'
-        vehicle.save()
-        vehicles_maintenance += 1
+    vehicles_maintenance = inactive_vehicles.update(etat='maintenance', updated_at=now)
 
     return {
         'clients_deactivated': clients_deactivated,
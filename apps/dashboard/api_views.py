@@ -8,10 +8,16 @@ from apps.billing.models import Facture, Paiement
 from apps.core.models import Client, Chauffeur, Vehicule, Destination, TypeService
 from apps.support.models import Incident, Reclamation
 from django.db.models import Count, Sum, Avg, Q
+from django.db import connection
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.db.models.functions import TruncMonth, TruncYear
 from datetime import datetime, timedelta
 from collections import defaultdict
+import hashlib
+import time
 from utils.reports_service import IncidentReportService, ReclamationReportService, DashboardKPIService
+from .models import MonthlyRollup
 
 class DashboardStatsView(APIView):
     permission_classes = [IsAuthenticated]
@@ -121,8 +127,42 @@ class DashboardStatsView(APIView):
     def _get_monthly_trends(self, start_date):
         trends = defaultdict(lambda: {'expeditions': 0, 'revenue': 0, 'incidents': 0})
 
+        if connection.vendor != 'postgresql':
+            self._add_live_monthly_trends(trends, [(start_date, None)])
+            return dict(trends)
+
+        # Closed months come from the nightly materialized view; only the partial
+        # first month and the current month are aggregated live
+        first_full_month = (start_date.replace(day=1) + timedelta(days=32)).replace(day=1).date()
+        current_month = datetime.now().replace(day=1).date()
+
+        rollup = MonthlyRollup.objects.filter(
+            month__gte=first_full_month, month__lt=current_month
+        ).values('source', 'month', 'value')
+
+        for item in rollup:
+            month_str = item['month'].strftime('%Y-%m')
+            if item['source'] == 'revenue':
+                trends[month_str]['revenue'] = float(item['value'])
+            else:
+                trends[month_str][item['source']] = int(item['value'])
+
+        self._add_live_monthly_trends(trends, [(start_date, first_full_month), (current_month, None)])
+        return dict(trends)
+
+    def _add_live_monthly_trends(self, trends, ranges):
+        """Aggregate monthly trends from the base tables over (start, end) ranges, end exclusive or None"""
+        def in_ranges(field):
+            query = Q()
+            for start, end in ranges:
+                bounds = {f'{field}__gte': start}
+                if end:
+                    bounds[f'{field}__lt'] = end
+                query |= Q(**bounds)
+            return query
+
         # Expeditions by month
-        expeditions_monthly = Expedition.objects.filter(date_creation__gte=start_date).annotate(
+        expeditions_monthly = Expedition.objects.filter(in_ranges('date_creation')).annotate(
             month=TruncMonth('date_creation')
         ).values('month').annotate(count=Count('id')).order_by('month')
 
@@ -131,7 +171,7 @@ class DashboardStatsView(APIView):
             trends[month_str]['expeditions'] = item['count']
 
         # Revenue by month
-        revenue_monthly = Facture.objects.filter(date_emission__gte=start_date).annotate(
+        revenue_monthly = Facture.objects.filter(in_ranges('date_emission')).annotate(
             month=TruncMonth('date_emission')
         ).values('month').annotate(total=Sum('montant_ttc')).order_by('month')
 
@@ -140,7 +180,7 @@ class DashboardStatsView(APIView):
             trends[month_str]['revenue'] = float(item['total'] or 0)
 
         # Incidents by month
-        incidents_monthly = Incident.objects.filter(date__gte=start_date).annotate(
+        incidents_monthly = Incident.objects.filter(in_ranges('date')).annotate(
             month=TruncMonth('date')
         ).values('month').annotate(count=Count('id')).order_by('month')
 
@@ -148,8 +188,6 @@ class DashboardStatsView(APIView):
             month_str = item['month'].strftime('%Y-%m')
             trends[month_str]['incidents'] = item['count']
 
-        return dict(trends)
-
 class ChartDataView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -249,8 +287,16 @@ class ChartDataView(APIView):
             }]
         }
 
+def dashboard_etag(request, *args, **kwargs):
+    """ETag for report endpoints: same path and query within the same minute share a response"""
+    minute_bucket = int(time.time() // 60)
+    return hashlib.md5(f"{request.path}:{request.GET.urlencode()}:{minute_bucket}".encode()).hexdigest()
+
+
+@cache_control(private=True, max_age=60)
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@condition(etag_func=dashboard_etag)
 def incident_reports(request):
     """Get incident statistical reports"""
     start_date = request.query_params.get('start_date')
@@ -286,8 +332,10 @@ def incident_reports(request):
     })
 
 
+@cache_control(private=True, max_age=60)
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@condition(etag_func=dashboard_etag)
 def reclamation_reports(request):
     """Get reclamation statistical reports"""
     start_date = request.query_params.get('start_date')
@@ -310,8 +358,10 @@ def reclamation_reports(request):
     })
 
 
+@cache_control(private=True, max_age=60)
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@condition(etag_func=dashboard_etag)
 def advanced_kpis(request):
     """Get advanced KPIs and forecasts for dashboard"""
     period_days = int(request.query_params.get('period_days', 30))
@@ -0,0 +1,62 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+ROLLUP_SQL = """
+CREATE MATERIALIZED VIEW monthly_dashboard_rollup AS
+SELECT ROW_NUMBER() OVER (ORDER BY source, month) AS id, source, month, value FROM (
+    SELECT 'expeditions' AS source,
+           DATE_TRUNC('month', date_creation AT TIME ZONE %(tz)s)::date AS month,
+           COUNT(*)::numeric AS value
+    FROM logistics_expedition GROUP BY 2
+    UNION ALL
+    SELECT 'revenue', DATE_TRUNC('month', date_emission)::date, COALESCE(SUM(montant_ttc), 0)
+    FROM billing_facture GROUP BY 2
+    UNION ALL
+    SELECT 'incidents', DATE_TRUNC('month', "date" AT TIME ZONE %(tz)s)::date, COUNT(*)::numeric
+    FROM support_incident GROUP BY 2
+) AS rollup;
+CREATE UNIQUE INDEX monthly_dashboard_rollup_source_month ON monthly_dashboard_rollup (source, month);
+"""
+
+
+def create_rollup_view(apps, schema_editor):
+    # Materialized views are PostgreSQL-only; other backends fall back to live aggregation
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(ROLLUP_SQL % {'tz': f"'{settings.TIME_ZONE}'"})
+
+
+def drop_rollup_view(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP MATERIALIZED VIEW IF EXISTS monthly_dashboard_rollup;")
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('billing', '0002_alter_facture_est_payee'),
+        ('logistics', '0005_alter_expedition_statut'),
+        ('support', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyRollup',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('source', models.CharField(choices=[('expeditions', 'Expéditions'), ('revenue', "Chiffre d'affaires"), ('incidents', 'Incidents')], max_length=20)),
+                ('month', models.DateField()),
+                ('value', models.DecimalField(decimal_places=2, max_digits=14)),
+            ],
+            options={
+                'db_table': 'monthly_dashboard_rollup',
+                'ordering': ['month'],
+                'managed': False,
+            },
+        ),
+        migrations.RunPython(create_rollup_view, drop_rollup_view),
+    ]
@@ -0,0 +1,23 @@
+from django.db import models
+
+
+class MonthlyRollup(models.Model):
+	"""Read-only mapping of the monthly_dashboard_rollup materialized view (PostgreSQL only)"""
+	SOURCE_CHOICES = [
+		('expeditions', 'Expéditions'),
+		('revenue', 'Chiffre d\'affaires'),
+		('incidents', 'Incidents'),
+	]
+
+	id = models.BigIntegerField(primary_key=True)
+	source = models.CharField(max_length=20, choices=SOURCE_CHOICES)
+	month = models.DateField()
+	value = models.DecimalField(max_digits=14, decimal_places=2)
+
+	class Meta:
+		managed = False
+		db_table = 'monthly_dashboard_rollup'
+		ordering = ['month']
+
+	def __str__(self):
+		return f"{self.source} {self.month:%Y-%m}: {self.value}"
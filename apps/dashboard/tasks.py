@@ -1,11 +1,13 @@
 from celery import shared_task
 from django.utils import timezone
-from datetime import timedelta
-from django.db.models import Count, Sum, Q
+from datetime import timedelta, timezone as dt_timezone
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, Sum, Q
+from django.db.models.functions import TruncDate
 from apps.logistics.models import Expedition, Tournee
 from apps.billing.models import Facture, Paiement
 from apps.core.models import Client, Chauffeur
 from apps.support.models import Incident
+from utils.calculators import calculate_tournee_cost
 
 
 @shared_task
@@ -175,25 +177,21 @@ def calculate_average_delivery_time(start_date, end_date):
     """
     Calculate average delivery time for completed expeditions
     """
-    completed_expeditions = Expedition.objects.filter(
+    # Whole days between the UTC calendar dates, averaged in the database
+    delivery_days = ExpressionWrapper(
+        TruncDate('date_livraison', tzinfo=dt_timezone.utc) - TruncDate('date_creation', tzinfo=dt_timezone.utc),
+        output_field=DurationField()
+    )
+    average = Expedition.objects.filter(
         date_livraison__date__range=[start_date, end_date],
         statut='livre',
         date_creation__isnull=False
-    )
+    ).aggregate(average=Avg(delivery_days))['average']
 
-    if not completed_expeditions:
+    if average is None:
         return 0
 
-    total_days = 0
-    count = 0
-
-    for expedition in completed_expeditions:
-        if expedition.date_livraison and expedition.date_creation:
-            delivery_time = (expedition.date_livraison.date() - expedition.date_creation.date()).days
-            total_days += delivery_time
-            count += 1
-
-    return round(total_days / count, 1) if count > 0 else 0
+    return round(average.total_seconds() / 86400, 1)
 
 
 def calculate_client_satisfaction(start_date, end_date):
@@ -245,18 +243,26 @@ def calculate_monthly_costs(start_date, end_date):
     """
     Calculate total operational costs for the month
     """
-    # This would integrate with the PriceCalculator for tournee costs
-    # For now, return a simplified calculation
-
-    tournees = Tournee.objects.filter(date__range=[start_date, end_date])
+    tournees = Tournee.objects.filter(date__range=[start_date, end_date]).only('kilometrage', 'consommation')
 
     total_costs = 0
-    for tournee in tournees:
-        # Simplified cost calculation
-        fuel_cost = tournee.consommation * 1.50  # €1.50 per liter
-        driver_cost = tournee.kilometrage * 0.50  # €0.50 per km for driver
-        maintenance_cost = tournee.kilometrage * 0.20  # €0.20 per km for maintenance
-
-        total_costs += fuel_cost + driver_cost + maintenance_cost
+    for tournee in tournees.iterator(chunk_size=500):
+        total_costs += calculate_tournee_cost(tournee.kilometrage, tournee.consommation)['total_cost']
 
     return round(total_costs, 2)
+
+
+@shared_task
+def refresh_monthly_rollup():
+    """
+    Refresh the monthly_dashboard_rollup materialized view used by the dashboard trends
+    """
+    from django.db import connection
+
+    if connection.vendor != 'postgresql':
+        return "Monthly rollup is only available on PostgreSQL"
+
+    with connection.cursor() as cursor:
+        cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY monthly_dashboard_rollup;")
+
+    return "Monthly dashboard rollup refreshed"
@@ -3,14 +3,63 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.filters import SearchFilter, OrderingFilter
-from django.db.models import Q, Sum, Count
+import logging
+from datetime import timedelta
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q, Sum, Count, Avg, Prefetch
 from django.utils import timezone
-from apps.users.permissions import CanCreateExpedition, CanModifyCriticalData, IsAgent
-from .models import Expedition, Tournee, TrackingLog
-from .serializers import ExpeditionSerializer, TourneeSerializer, TrackingLogSerializer
-from .prediction_service import prediction_service
+from apps.users.permissions import CanCreateExpedition, CanModifyCriticalData, IsAgent, user_has_perm
+from .models import Expedition, ExpeditionStatusHistory, ExpeditionTimeInStatus, Tournee, TrackingLog
+from .notification_service import NotificationService
+from .serializers import ExpeditionSerializer, ExpeditionStatusChangeSerializer, TourneeSerializer, TrackingLogSerializer
+from .tasks import predict_delivery_time
 from utils.calculators import calculate_shipping_cost
 
+logger = logging.getLogger(__name__)
+
+# Columns rendered by ExpeditionSerializer, loaded on list pages instead of full rows
+EXPEDITION_LIST_FIELDS = (
+    'id', 'numero', 'poids', 'volume', 'description', 'montant', 'statut',
+    'date_creation', 'date_livraison', 'created_at', 'updated_at', 'is_active',
+    'client__nom', 'client__prenom', 'type_service__nom',
+    'destination__ville', 'destination__pays', 'tournee__date',
+)
+
+EXPEDITION_STATS_CACHE_KEY = 'expedition:stats:v1'
+EXPEDITION_STATS_CACHE_TIMEOUT = 60
+
+
+def schedule_delivery_prediction(expedition_id):
+    """Queue the delivery time prediction; a broker outage must not fail the create"""
+    try:
+        predict_delivery_time.delay(expedition_id)
+    except Exception as e:
+        logger.error(f"Failed to queue delivery time prediction for expedition {expedition_id}: {e}")
+
+
+def _time_in_status_from_history():
+    """Average time spent in each status, computed from the raw status history"""
+    totals = {}
+    previous = None
+    history = ExpeditionStatusHistory.objects.order_by('expedition_id', 'timestamp', 'id').values_list(
+        'expedition_id', 'new_status', 'timestamp'
+    )
+    for expedition_id, new_status, timestamp in history.iterator(chunk_size=2000):
+        if previous and previous[0] == expedition_id:
+            total, count = totals.get(previous[1], (timedelta(0), 0))
+            totals[previous[1]] = (total + (timestamp - previous[2]), count + 1)
+        previous = (expedition_id, new_status, timestamp)
+    return {status_: (total / count, count) for status_, (total, count) in totals.items()}
+
+
+def invalidate_expedition_statistics():
+    """Drop the cached expedition statistics; a cache outage must not fail the write"""
+    try:
+        cache.delete(EXPEDITION_STATS_CACHE_KEY)
+    except Exception as e:
+        logger.warning(f"Failed to invalidate expedition statistics cache: {e}")
+
 
 class ExpeditionViewSet(viewsets.ModelViewSet):
     queryset = Expedition.objects.select_related('client', 'type_service', 'destination', 'tournee__chauffeur', 'tournee__vehicule')
@@ -26,6 +75,11 @@ class ExpeditionViewSet(viewsets.ModelViewSet):
         queryset = super().get_queryset()
         user = self.request.user
 
+        if self.action == 'list':
+            queryset = queryset.select_related(None).select_related(
+                'client', 'type_service', 'destination', 'tournee'
+            ).only(*EXPEDITION_LIST_FIELDS)
+
         # Filter based on user role
         if user.role == 'agent':
             # Agents can see expeditions they created or are assigned to
@@ -37,54 +91,80 @@ class ExpeditionViewSet(viewsets.ModelViewSet):
         return queryset
 
     def perform_create(self, serializer):
+        data = serializer.validated_data
+
         # Auto-generate expedition number
-        last_exp = Expedition.objects.order_by('-id').first()
-        next_num = f"EXP{(last_exp.id + 1) if last_exp else 1:06d}"
-        numero = serializer.validated_data.get('numero') or next_num
+        numero = data.get('numero') or Expedition.next_numero()
+        extra_fields = {'numero': numero}
 
         # Calculate shipping cost
-        expedition = serializer.save(numero=numero)
         try:
-            montant = calculate_shipping_cost(
-                expedition.type_service,
-                expedition.destination,
-                expedition.poids,
-                expedition.volume
+            extra_fields['montant'] = calculate_shipping_cost(
+                data['type_service'],
+                data['destination'],
+                data['poids'],
+                data['volume']
             )
-            expedition.montant = montant
-            expedition.save()
         except ValueError as e:
             # If calculation fails, keep montant as provided or set to 0
-            expedition.montant = expedition.montant or 0
-            expedition.save()
+            extra_fields['montant'] = data.get('montant') or 0
+
+        with transaction.atomic():
+            expedition = serializer.save(**extra_fields)
+            if expedition.tournee_id:
+                Tournee.apply_expedition_totals(expedition.tournee_id, expedition.pk)
+            transaction.on_commit(invalidate_expedition_statistics)
+            # Delivery time prediction runs in a worker once the row is visible
+            transaction.on_commit(lambda: schedule_delivery_prediction(expedition.id))
+
+    def perform_update(self, serializer):
+        instance = serializer.instance
+        data = serializer.validated_data
+        old_tournee_id = instance.tournee_id
+        new_tournee = data.get('tournee', instance.tournee)
+        new_tournee_id = new_tournee.pk if new_tournee else None
+        totals_change = (
+            new_tournee_id != old_tournee_id
+            or data.get('poids', instance.poids) != instance.poids
+            or data.get('volume', instance.volume) != instance.volume
+        )
 
-        # Generate delivery time prediction
-        try:
-            predicted_time = prediction_service.predict_delivery_time(expedition)
-            if predicted_time:
-                expedition.predicted_delivery_time = predicted_time
-                expedition.save()
-        except Exception as e:
-            # Log error but don't fail creation
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.error(f"Failed to predict delivery time for expedition {expedition.numero}: {e}")
+        with transaction.atomic():
+            # Take the stored row out of its old tour's totals before it changes, add it back after
+            if totals_change and old_tournee_id:
+                Tournee.apply_expedition_totals(old_tournee_id, instance.pk, removed=True)
+            serializer.save()
+            if totals_change and new_tournee_id:
+                Tournee.apply_expedition_totals(new_tournee_id, instance.pk)
+        invalidate_expedition_statistics()
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            if instance.tournee_id:
+                # The totals UPDATE reads the row, so it must run before the delete
+                Tournee.apply_expedition_totals(instance.tournee_id, instance.pk, removed=True)
+            instance.delete()
+        invalidate_expedition_statistics()
 
     @action(detail=True, methods=['post'])
     def assign_to_tour(self, request, pk=None):
-        expedition = self.get_object()
         tournee_id = request.data.get('tournee_id')
 
-        if expedition.tournee:
+        if not Tournee.objects.filter(id=tournee_id).exists():
+            return Response({'error': 'Tour not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        # The WHERE clause enforces "not yet assigned" atomically, no read-then-write race
+        with transaction.atomic():
+            assigned = self.get_queryset().filter(pk=pk, tournee__isnull=True).update(
+                tournee_id=tournee_id, updated_at=timezone.now()
+            )
+            if assigned:
+                Tournee.apply_expedition_totals(tournee_id, pk)
+        if not assigned:
+            self.get_object()  # 404 if the expedition is missing or not visible
             return Response({'error': 'Expedition already assigned to a tour'}, status=status.HTTP_400_BAD_REQUEST)
 
-        try:
-            tournee = Tournee.objects.get(id=tournee_id)
-            expedition.tournee = tournee
-            expedition.save()
-            return Response({'message': 'Expedition assigned to tour successfully'})
-        except Tournee.DoesNotExist:
-            return Response({'error': 'Tour not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'message': 'Expedition assigned to tour successfully'})
 
     @action(detail=True, methods=['post'])
     def update_status(self, request, pk=None):
@@ -95,39 +175,119 @@ class ExpeditionViewSet(viewsets.ModelViewSet):
             return Response({'error': 'Invalid status'}, status=status.HTTP_400_BAD_REQUEST)
 
         # Check permissions for status changes
-        if new_status in ['livre', 'echec'] and not request.user.has_perm('logistics.change_expedition_status'):
+        if new_status in ['livre', 'echec'] and not user_has_perm(request, 'logistics.change_expedition_status'):
             return Response({'error': 'Permission denied'}, status=status.HTTP_403_FORBIDDEN)
 
         expedition.statut = new_status
         if new_status == 'livre':
             expedition.date_livraison = timezone.now()
         expedition.save()
+        invalidate_expedition_statistics()
 
         return Response({'message': f'Status updated to {new_status}'})
 
+    @action(detail=False, methods=['post'])
+    def bulk_update_status(self, request):
+        changes = request.data.get('changes')
+        if not isinstance(changes, list) or not changes:
+            return Response({'error': 'changes must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+
+        change_serializer = ExpeditionStatusChangeSerializer(data=changes, many=True)
+        if not change_serializer.is_valid():
+            return Response(
+                {'error': 'Invalid changes', 'details': change_serializer.errors},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Group expedition ids by target status
+        groups = {}
+        for change in change_serializer.validated_data:
+            groups.setdefault(change['statut'], set()).add(change['id'])
+
+        if groups.keys() & {'livre', 'echec'} and not user_has_perm(request, 'logistics.change_expedition_status'):
+            return Response({'error': 'Permission denied'}, status=status.HTTP_403_FORBIDDEN)
+
+        now = timezone.now()
+        history = []
+        updated_ids = {}
+        with transaction.atomic():
+            for new_status, ids in groups.items():
+                previous = list(
+                    self.get_queryset().filter(pk__in=ids).exclude(statut=new_status)
+                    .select_for_update(of=('self',)).values_list('id', 'statut')
+                )
+                if not previous:
+                    continue
+
+                fields = {'statut': new_status, 'updated_at': now}
+                if new_status == 'livre':
+                    fields['date_livraison'] = now
+                updated_ids[new_status] = [pk for pk, _ in previous]
+                Expedition.objects.filter(pk__in=updated_ids[new_status]).update(**fields)
+
+                history.extend(
+                    ExpeditionStatusHistory(expedition_id=pk, old_status=old_status, new_status=new_status, changed_by=request.user)
+                    for pk, old_status in previous
+                )
+            ExpeditionStatusHistory.objects.bulk_create(history, batch_size=500)
+
+        if history:
+            invalidate_expedition_statistics()
+            for new_status, ids in updated_ids.items():
+                NotificationService.notify_bulk_status_change(ids, new_status)
+
+        return Response({'updated': len(history)})
+
     @action(detail=True, methods=['get'])
     def tracking_history(self, request, pk=None):
         expedition = self.get_object()
-        tracking_logs = expedition.trackings.all().order_by('-date')
-        serializer = TrackingLogSerializer(tracking_logs, many=True)
-        return Response(serializer.data)
+        tracking_logs = expedition.trackings.select_related('chauffeur').order_by('-date')
+        page = self.paginate_queryset(tracking_logs)
+        serializer = TrackingLogSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=['get'])
+    def time_in_status(self, request):
+        if connection.vendor == 'postgresql':
+            rows = ExpeditionTimeInStatus.objects.filter(duration__isnull=False).values('status').annotate(
+                average=Avg('duration'), transitions=Count('id')
+            )
+            durations = {row['status']: (row['average'], row['transitions']) for row in rows}
+        else:
+            durations = _time_in_status_from_history()
+
+        return Response([
+            {
+                'statut': status_,
+                'average_hours': round(average.total_seconds() / 3600, 1),
+                'transitions': transitions
+            }
+            for status_, (average, transitions) in sorted(durations.items())
+        ])
 
     @action(detail=False, methods=['get'])
     def statistics(self, request):
-        stats = Expedition.objects.aggregate(
-            total_expeditions=Count('id'),
-            total_weight=Sum('poids'),
-            total_volume=Sum('volume'),
-            total_revenue=Sum('montant'),
-            delivered=Count('id', filter=Q(statut='livre')),
-            in_transit=Count('id', filter=Q(statut='en_transit')),
-            failed=Count('id', filter=Q(statut='echec'))
-        )
+        def compute():
+            return Expedition.objects.aggregate(
+                total_expeditions=Count('id'),
+                total_weight=Sum('poids'),
+                total_volume=Sum('volume'),
+                total_revenue=Sum('montant'),
+                delivered=Count('id', filter=Q(statut='livre')),
+                in_transit=Count('id', filter=Q(statut='en_transit')),
+                failed=Count('id', filter=Q(statut='echec'))
+            )
+
+        try:
+            stats = cache.get_or_set(EXPEDITION_STATS_CACHE_KEY, compute, timeout=EXPEDITION_STATS_CACHE_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Expedition statistics cache unavailable: {e}")
+            stats = compute()
         return Response(stats)
 
 
 class TourneeViewSet(viewsets.ModelViewSet):
-    queryset = Tournee.objects.select_related('chauffeur', 'vehicule').prefetch_related('expeditions')
+    queryset = Tournee.objects.select_related('chauffeur', 'vehicule')
     serializer_class = TourneeSerializer
     permission_classes = [permissions.IsAuthenticated, CanModifyCriticalData]
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
@@ -136,44 +296,51 @@ class TourneeViewSet(viewsets.ModelViewSet):
     ordering_fields = ['date', 'kilometrage', 'duree', 'consommation']
     ordering = ['-date']
 
-    def perform_create(self, serializer):
-        tournee = serializer.save()
-        # Auto-calculate totals based on assigned expeditions
-        self._update_tournee_totals(tournee)
+    def get_queryset(self):
+        queryset = super().get_queryset()
+
+        # Only the detail views render the expeditions; everything else just needs their count
+        if self.action in ('retrieve', 'expeditions_list'):
+            return queryset.prefetch_related(Prefetch(
+                'expeditions',
+                queryset=Expedition.objects.select_related('client', 'type_service', 'destination')
+            ))
+        return queryset.annotate(expedition_count=Count('expeditions'))
 
     @action(detail=True, methods=['post'])
     def add_expedition(self, request, pk=None):
         tournee = self.get_object()
         expedition_id = request.data.get('expedition_id')
 
-        try:
-            expedition = Expedition.objects.get(id=expedition_id)
-            if expedition.tournee:
+        with transaction.atomic():
+            assigned = Expedition.objects.filter(id=expedition_id, tournee__isnull=True).update(
+                tournee=tournee, updated_at=timezone.now()
+            )
+            if assigned:
+                Tournee.apply_expedition_totals(tournee.pk, expedition_id)
+        if not assigned:
+            if Expedition.objects.filter(id=expedition_id).exists():
                 return Response({'error': 'Expedition already assigned to a tour'}, status=status.HTTP_400_BAD_REQUEST)
-
-            expedition.tournee = tournee
-            expedition.save()
-            self._update_tournee_totals(tournee)
-
-            return Response({'message': 'Expedition added to tour successfully'})
-        except Expedition.DoesNotExist:
             return Response({'error': 'Expedition not found'}, status=status.HTTP_404_NOT_FOUND)
 
+        return Response({'message': 'Expedition added to tour successfully'})
+
     @action(detail=True, methods=['post'])
     def remove_expedition(self, request, pk=None):
         tournee = self.get_object()
         expedition_id = request.data.get('expedition_id')
 
-        try:
-            expedition = Expedition.objects.get(id=expedition_id, tournee=tournee)
-            expedition.tournee = None
-            expedition.save()
-            self._update_tournee_totals(tournee)
-
-            return Response({'message': 'Expedition removed from tour successfully'})
-        except Expedition.DoesNotExist:
+        with transaction.atomic():
+            removed = Expedition.objects.filter(id=expedition_id, tournee=tournee).update(
+                tournee=None, updated_at=timezone.now()
+            )
+            if removed:
+                Tournee.apply_expedition_totals(tournee.pk, expedition_id, removed=True)
+        if not removed:
             return Response({'error': 'Expedition not found in this tour'}, status=status.HTTP_404_NOT_FOUND)
 
+        return Response({'message': 'Expedition removed from tour successfully'})
+
     @action(detail=True, methods=['get'])
     def expeditions_list(self, request, pk=None):
         tournee = self.get_object()
@@ -181,21 +348,6 @@ class TourneeViewSet(viewsets.ModelViewSet):
         serializer = ExpeditionSerializer(expeditions, many=True)
         return Response(serializer.data)
 
-    def _update_tournee_totals(self, tournee):
-        expeditions = tournee.expeditions.all()
-        if expeditions.exists():
-            # Calculate totals
-            total_weight = sum(exp.poids for exp in expeditions)
-            total_volume = sum(exp.volume for exp in expeditions)
-
-            # Estimate distance based on number of expeditions (50km per expedition)
-            tournee.kilometrage = len(expeditions) * 50
-
-            # Calculate fuel consumption
-            tournee.consommation = (tournee.kilometrage * tournee.vehicule.consommation) / 100
-
-            tournee.save()
-
 
 class TrackingLogViewSet(viewsets.ModelViewSet):
     queryset = TrackingLog.objects.select_related('expedition', 'chauffeur')
@@ -0,0 +1,57 @@
+"""
+Server-side marker clustering for the expedition maps
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+MIN_ZOOM = 0
+MAX_ZOOM = 18
+CLUSTER_RADIUS = 40  # Cluster radius in pixels
+TILE_SIZE = 512  # Tile extent in pixels
+
+
+def project(lats, lngs):
+    """Project lat/lng degrees to Web Mercator coordinates in the unit square"""
+    sin_lat = np.sin(np.radians(lats))
+    x = lngs / 360 + 0.5
+    y = 0.5 - 0.25 * np.log((1 + sin_lat) / (1 - sin_lat)) / np.pi
+    return x, np.clip(y, 0, 1)
+
+
+def unproject(x, y):
+    """Inverse of project, back to lat/lng degrees"""
+    lngs = (x - 0.5) * 360
+    lats = 360 * np.arctan(np.exp((180 - y * 360) * np.pi / 180)) / np.pi - 90
+    return lats, lngs
+
+
+def cluster_points(latlngs, zoom, radius=CLUSTER_RADIUS):
+    """
+    Greedily merge the points within `radius` pixels of each other at `zoom`
+
+    Returns a list of {'lat', 'lng', 'count'} centroids, weighted by the number of merged points
+    """
+    if not latlngs:
+        return []
+
+    zoom = min(max(int(zoom), MIN_ZOOM), MAX_ZOOM)
+    coords = np.asarray(latlngs, dtype=np.float64)
+    x, y = project(coords[:, 0], coords[:, 1])
+    points = np.column_stack((x, y))
+    tree = cKDTree(points)
+    r = radius / (TILE_SIZE * 2 ** zoom)
+
+    clustered = np.zeros(len(points), dtype=bool)
+    clusters = []
+    for i in range(len(points)):
+        if clustered[i]:
+            continue
+        neighbors = np.asarray(tree.query_ball_point(points[i], r), dtype=np.intp)
+        neighbors = neighbors[~clustered[neighbors]]
+        clustered[neighbors] = True
+
+        cx, cy = points[neighbors].mean(axis=0)
+        lat, lng = unproject(cx, cy)
+        clusters.append({'lat': float(lat), 'lng': float(lng), 'count': int(len(neighbors))})
+
+    return clusters
@@ -2,18 +2,28 @@
 WebSocket Consumers for Real-Time Tracking
 Handles real-time updates for expeditions and tournees
 """
-import json
+import asyncio
+import logging
+import orjson
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from apps.logistics.models import Expedition, Tournee, TrackingLog
 
+logger = logging.getLogger(__name__)
+
 
 class ExpeditionTrackingConsumer(AsyncWebsocketConsumer):
     """WebSocket consumer for real-time expedition tracking"""
     
+    # Location pings are buffered and written with one bulk INSERT
+    LOCATION_FLUSH_SIZE = 20
+    LOCATION_FLUSH_INTERVAL = 1  # seconds
+    
     async def connect(self):
         self.expedition_id = self.scope['url_route']['kwargs']['expedition_id']
         self.room_group_name = f'expedition_{self.expedition_id}'
+        self._pending_locations = []
+        self._flush_task = asyncio.create_task(self._flush_loop())
         
         # Join room group
         await self.channel_layer.group_add(
@@ -25,21 +35,27 @@ class ExpeditionTrackingConsumer(AsyncWebsocketConsumer):
         
         # Send current expedition data
         expedition_data = await self.get_expedition_data()
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=orjson.dumps({
             'type': 'expedition_data',
             'data': expedition_data
-        }))
+        }).decode())
     
     async def disconnect(self, close_code):
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        # Stop the periodic flush and write any buffered positions before leaving
+        if getattr(self, '_flush_task', None):
+            self._flush_task.cancel()
+        try:
+            await self.flush_locations()
+        finally:
+            # Leave room group even if the flush failed
+            await self.channel_layer.group_discard(
+                self.room_group_name,
+                self.channel_name
+            )
     
     async def receive(self, text_data):
         """Handle incoming WebSocket messages"""
-        data = json.dumps(text_data)
+        data = orjson.loads(text_data)
         message_type = data.get('type')
         
         if message_type == 'update_location':
@@ -48,66 +64,88 @@ class ExpeditionTrackingConsumer(AsyncWebsocketConsumer):
     
     async def expedition_update(self, event):
         """Send expedition update to WebSocket"""
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=orjson.dumps({
             'type': 'expedition_update',
             'data': event['data']
-        }))
+        }).decode())
     
     async def location_update(self, event):
         """Send location update to WebSocket"""
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=orjson.dumps({
             'type': 'location_update',
             'data': event['data']
-        }))
+        }).decode())
     
     async def status_update(self, event):
         """Send status update to WebSocket"""
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=orjson.dumps({
             'type': 'status_update',
             'data': event['data']
-        }))
+        }).decode())
     
     @database_sync_to_async
     def get_expedition_data(self):
         """Get expedition data from database"""
-        try:
-            expedition = Expedition.objects.select_related('client', 'destination', 'type_service').get(id=self.expedition_id)
-            return {
-                'id': expedition.id,
-                'numero': expedition.numero,
-                'statut': expedition.statut,
-                'client': str(expedition.client),
-                'destination': str(expedition.destination),
-                'poids': str(expedition.poids),
-                'volume': str(expedition.volume),
-                'date_creation': expedition.date_creation.isoformat(),
-                'trackings': [
-                    {
-                        'lieu': t.lieu,
-                        'statut': t.statut,
-                        'date': t.date.isoformat(),
-                        'commentaire': t.commentaire
-                    }
-                    for t in expedition.trackings.all().order_by('-date')[:10]
-                ]
-            }
-        except Expedition.DoesNotExist:
+        expedition = Expedition.objects.filter(id=self.expedition_id).values(
+            'id', 'numero', 'statut', 'poids', 'volume', 'date_creation',
+            'client__nom', 'client__prenom', 'destination__ville', 'destination__pays'
+        ).first()
+        if expedition is None:
             return None
+        
+        trackings = TrackingLog.objects.filter(expedition_id=self.expedition_id).order_by('-date').values(
+            'lieu', 'statut', 'date', 'commentaire'
+        )[:10]
+        return {
+            'id': expedition['id'],
+            'numero': expedition['numero'],
+            'statut': expedition['statut'],
+            'client': f"{expedition['client__nom']} {expedition['client__prenom']}",
+            'destination': f"{expedition['destination__ville']}, {expedition['destination__pays']}",
+            'poids': str(expedition['poids']),
+            'volume': str(expedition['volume']),
+            'date_creation': expedition['date_creation'],
+            'trackings': list(trackings)
+        }
+    
+    async def update_location(self, latitude, longitude, lieu):
+        """Buffer an expedition location, flushing early when the batch is full"""
+        self._pending_locations.append({
+            'lieu': lieu,
+            'commentaire': f"Position: {latitude}, {longitude}"
+        })
+        
+        if len(self._pending_locations) >= self.LOCATION_FLUSH_SIZE:
+            await self.flush_locations()
+    
+    async def _flush_loop(self):
+        """Flush buffered locations every LOCATION_FLUSH_INTERVAL seconds"""
+        while True:
+            await asyncio.sleep(self.LOCATION_FLUSH_INTERVAL)
+            try:
+                await self.flush_locations()
+            except Exception as e:
+                logger.error(f"Failed to save locations for expedition {self.expedition_id}: {e}")
+    
+    async def flush_locations(self):
+        """Write buffered locations to the database"""
+        pending = getattr(self, '_pending_locations', None)
+        if not pending:
+            return
+        self._pending_locations = []
+        await self.save_locations(pending)
     
     @database_sync_to_async
-    def update_location(self, latitude, longitude, lieu):
-        """Update expedition location"""
-        try:
-            expedition = Expedition.objects.get(id=self.expedition_id)
-            TrackingLog.objects.create(
-                expedition=expedition,
-                lieu=lieu,
-                statut=expedition.statut,
-                commentaire=f"Position: {latitude}, {longitude}"
-            )
-            return True
-        except Expedition.DoesNotExist:
+    def save_locations(self, locations):
+        """Insert tracking logs for a batch of locations in a single query"""
+        statut = Expedition.objects.filter(id=self.expedition_id).values_list('statut', flat=True).first()
+        if statut is None:
             return False
+        TrackingLog.objects.bulk_create([
+            TrackingLog(expedition_id=self.expedition_id, statut=statut, **location)
+            for location in locations
+        ], batch_size=500, ignore_conflicts=True)
+        return True
 
 
 class TourneeTrackingConsumer(AsyncWebsocketConsumer):
@@ -127,10 +165,10 @@ class TourneeTrackingConsumer(AsyncWebsocketConsumer):
         
         # Send current tournee data
         tournee_data = await self.get_tournee_data()
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=orjson.dumps({
             'type': 'tournee_data',
             'data': tournee_data
-        }))
+        }).decode())
     
     async def disconnect(self, close_code):
         # Leave room group
@@ -141,7 +179,7 @@ class TourneeTrackingConsumer(AsyncWebsocketConsumer):
     
     async def receive(self, text_data):
         """Handle incoming WebSocket messages"""
-        data = json.loads(text_data)
+        data = orjson.loads(text_data)
         message_type = data.get('type')
         
         if message_type == 'update_progress':
@@ -149,34 +187,39 @@ class TourneeTrackingConsumer(AsyncWebsocketConsumer):
     
     async def tournee_update(self, event):
         """Send tournee update to WebSocket"""
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=orjson.dumps({
             'type': 'tournee_update',
             'data': event['data']
-        }))
+        }).decode())
     
     @database_sync_to_async
     def get_tournee_data(self):
         """Get tournee data from database"""
-        try:
-            tournee = Tournee.objects.select_related('chauffeur', 'vehicule').prefetch_related('expeditions').get(id=self.tournee_id)
-            return {
-                'id': tournee.id,
-                'date': tournee.date.isoformat(),
-                'chauffeur': str(tournee.chauffeur),
-                'vehicule': str(tournee.vehicule),
-                'kilometrage': str(tournee.kilometrage),
-                'expeditions': [
-                    {
-                        'id': exp.id,
-                        'numero': exp.numero,
-                        'statut': exp.statut,
-                        'destination': str(exp.destination)
-                    }
-                    for exp in tournee.expeditions.all()
-                ]
-            }
-        except Tournee.DoesNotExist:
+        tournee = Tournee.objects.filter(id=self.tournee_id).values(
+            'id', 'date', 'kilometrage', 'chauffeur__nom', 'chauffeur__prenom', 'vehicule__immatriculation'
+        ).first()
+        if tournee is None:
             return None
+        
+        expeditions = Expedition.objects.filter(tournee_id=self.tournee_id).values(
+            'id', 'numero', 'statut', 'destination__ville', 'destination__pays'
+        )
+        return {
+            'id': tournee['id'],
+            'date': tournee['date'],
+            'chauffeur': f"{tournee['chauffeur__nom']} {tournee['chauffeur__prenom']}",
+            'vehicule': tournee['vehicule__immatriculation'],
+            'kilometrage': str(tournee['kilometrage']),
+            'expeditions': [
+                {
+                    'id': exp['id'],
+                    'numero': exp['numero'],
+                    'statut': exp['statut'],
+                    'destination': f"{exp['destination__ville']}, {exp['destination__pays']}"
+                }
+                for exp in expeditions
+            ]
+        }
     
     @database_sync_to_async
     def update_progress(self, progress):
@@ -214,7 +257,7 @@ class NotificationConsumer(AsyncWebsocketConsumer):
     
     async def notification(self, event):
         """Send notification to WebSocket"""
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=orjson.dumps({
             'type': 'notification',
             'data': event['data']
-        }))
+        }).decode())
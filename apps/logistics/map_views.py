@@ -1,52 +1,80 @@
 """
 Geographic map views for expedition tracking and visualization
 """
-import folium
-from folium.plugins import MarkerCluster, HeatMap
+import numpy as np
+from django.core.cache import cache
+from django.db.models import Count, Max
 from django.http import HttpResponse
+from django.utils.html import escape
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
+from apps.logistics.cluster import MAX_ZOOM, cluster_points
 from apps.logistics.models import Expedition, Tournee, TrackingLog
 from apps.core.models import Destination
+from utils.renderers import MessagePackRenderer, ORJSONRenderer, pack_coords
 import json
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Rows fetched per round trip when streaming map data from the database cursor
+MAP_FETCH_CHUNK_SIZE = 1000
+
 class ExpeditionMapView(APIView):
     """API view for expedition map data"""
     permission_classes = [IsAuthenticated]
+    renderer_classes = [JSONRenderer, MessagePackRenderer]
 
     def get(self, request):
-        """Get expedition locations for mapping"""
+        """Get expedition locations for mapping, optionally limited to ?bbox=minLng,minLat,maxLng,maxLat"""
+        bbox = request.query_params.get('bbox')
+        if bbox:
+            try:
+                min_lng, min_lat, max_lng, max_lat = (float(value) for value in bbox.split(','))
+            except ValueError:
+                return Response({'error': 'bbox must be minLng,minLat,maxLng,maxLat'}, status=400)
+
         try:
-            # Get active expeditions with destinations
+            # Get active expeditions with located destinations as plain rows
             expeditions = Expedition.objects.filter(
                 is_active=True,
-                destination__isnull=False
-            ).select_related('client', 'destination', 'agent_responsable')
-
-            expedition_data = []
-            for exp in expeditions:
-                if exp.destination.latitude and exp.destination.longitude:
-                    expedition_data.append({
-                        'id': exp.id,
-                        'numero': exp.numero,
-                        'statut': exp.statut,
-                        'client': exp.client.nom if exp.client else 'N/A',
-                        'destination': exp.destination.nom,
-                        'lat': exp.destination.latitude,
-                        'lng': exp.destination.longitude,
-                        'poids': float(exp.poids),
-                        'volume': float(exp.volume),
-                        'agent': exp.agent_responsable.username if exp.agent_responsable else None,
-                        'date_creation': exp.date_creation.isoformat() if exp.date_creation else None,
-                        'date_livraison': exp.date_livraison.isoformat() if exp.date_livraison else None
-                    })
+                destination__latitude__isnull=False,
+                destination__longitude__isnull=False
+            )
+            if bbox:
+                # Only the markers inside the client viewport
+                expeditions = expeditions.filter(
+                    destination__latitude__range=(min_lat, max_lat),
+                    destination__longitude__range=(min_lng, max_lng)
+                )
+            expeditions = expeditions.values(
+                'id', 'numero', 'statut', 'client__nom', 'destination__nom',
+                'destination__latitude', 'destination__longitude', 'poids', 'volume',
+                'agent_responsable__username', 'date_creation', 'date_livraison'
+            )
+
+            expedition_data = [
+                {
+                    'id': exp['id'],
+                    'numero': exp['numero'],
+                    'statut': exp['statut'],
+                    'client': exp['client__nom'] or 'N/A',
+                    'destination': exp['destination__nom'],
+                    'lat': exp['destination__latitude'],
+                    'lng': exp['destination__longitude'],
+                    'poids': float(exp['poids']),
+                    'volume': float(exp['volume']),
+                    'agent': exp['agent_responsable__username'],
+                    'date_creation': exp['date_creation'].isoformat() if exp['date_creation'] else None,
+                    'date_livraison': exp['date_livraison'].isoformat() if exp['date_livraison'] else None
+                }
+                for exp in expeditions.iterator(chunk_size=MAP_FETCH_CHUNK_SIZE)
+            ]
 
             return Response({
                 'expeditions': expedition_data,
@@ -61,6 +89,7 @@ class ExpeditionMapView(APIView):
 class TourneeMapView(APIView):
     """API view for tournee tracking map"""
     permission_classes = [IsAuthenticated]
+    renderer_classes = [JSONRenderer, MessagePackRenderer]
 
     def get(self, request, tournee_id=None):
         """Get tournee route and expedition locations"""
@@ -68,33 +97,32 @@ class TourneeMapView(APIView):
             if not tournee_id:
                 return Response({'error': 'Tournee ID required'}, status=400)
 
-            tournee = Tournee.objects.filter(id=tournee_id).first()
+            tournee = Tournee.objects.select_related('chauffeur', 'vehicule').filter(id=tournee_id).first()
             if not tournee:
                 return Response({'error': 'Tournee not found'}, status=404)
 
-            # Get expeditions for this tournee
-            expeditions = tournee.expeditions.filter(
-                destination__isnull=False
-            ).select_related('destination', 'client')
+            # Get located expeditions for this tournee as plain rows
+            rows = list(tournee.expeditions.filter(
+                destination__latitude__isnull=False
+            ).values(
+                'id', 'numero', 'destination__latitude', 'destination__longitude', 'client__nom', 'statut'
+            ))
 
             route_points = []
             expedition_markers = []
 
-            for exp in expeditions:
-                if exp.destination.latitude and exp.destination.longitude:
+            for row in rows:
+                lat, lng = row['destination__latitude'], row['destination__longitude']
+                if lat and lng:
                     expedition_markers.append({
-                        'id': exp.id,
-                        'numero': exp.numero,
-                        'lat': exp.destination.latitude,
-                        'lng': exp.destination.longitude,
-                        'client': exp.client.nom if exp.client else 'N/A',
-                        'statut': exp.statut
+                        'id': row['id'],
+                        'numero': row['numero'],
+                        'lat': lat,
+                        'lng': lng,
+                        'client': row['client__nom'] or 'N/A',
+                        'statut': row['statut']
                     })
-
-                    route_points.append([
-                        exp.destination.latitude,
-                        exp.destination.longitude
-                    ])
+                    route_points.append([lat, lng])
 
             # Add depot as starting point (assuming coordinates)
             depot_lat, depot_lng = 48.8566, 2.3522  # Paris coordinates as example
@@ -134,31 +162,28 @@ def tournee_map_view(request, tournee_id):
         return render(request, '404.html', status=404)
 
 
+HEAT_MAP_PRECISION = 6  # 1e-6 degree, about 0.11 m
+
+
 class HeatMapView(APIView):
     """API view for delivery heat map"""
     permission_classes = [IsAuthenticated]
+    renderer_classes = [ORJSONRenderer, MessagePackRenderer]
 
     def get(self, request):
         """Get heat map data for deliveries"""
         try:
-            # Get completed deliveries
-            deliveries = Expedition.objects.filter(
+            # Get completed deliveries; every point has the same weight on the heat map
+            coords = list(Expedition.objects.filter(
                 statut='livre',
                 destination__latitude__isnull=False,
                 destination__longitude__isnull=False
-            ).select_related('destination')
-
-            heat_data = []
-            for delivery in deliveries:
-                heat_data.append([
-                    delivery.destination.latitude,
-                    delivery.destination.longitude,
-                    1  # Weight for heat map
-                ])
+            ).values_list('destination__latitude', 'destination__longitude').iterator(chunk_size=MAP_FETCH_CHUNK_SIZE))
 
             return Response({
-                'heat_data': heat_data,
-                'total_deliveries': len(heat_data)
+                'coords': pack_coords(coords, precision=HEAT_MAP_PRECISION),
+                'count': len(coords),
+                'precision': HEAT_MAP_PRECISION
             })
 
         except Exception as e:
@@ -166,40 +191,126 @@ class HeatMapView(APIView):
             return Response({'error': 'Failed to load heat map'}, status=500)
 
 
-def generate_expedition_map_html():
+CLUSTER_CACHE_TIMEOUT = 3600
+
+
+class ClusterView(APIView):
+    """API view for expedition marker clusters pre-computed for a zoom level"""
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [JSONRenderer, MessagePackRenderer]
+
+    def get(self, request, zoom=None):
+        """Get cluster centroids and counts for ?zoom= (0-18)"""
+        try:
+            zoom = int(zoom if zoom is not None else request.query_params.get('zoom', 0))
+        except (TypeError, ValueError):
+            return Response({'error': 'zoom must be an integer'}, status=400)
+        if not 0 <= zoom <= MAX_ZOOM:
+            return Response({'error': f'zoom must be between 0 and {MAX_ZOOM}'}, status=400)
+
+        try:
+            expeditions = Expedition.objects.filter(
+                is_active=True,
+                destination__latitude__isnull=False,
+                destination__longitude__isnull=False
+            )
+            # Clusters only change when an active expedition does
+            snapshot = expeditions.aggregate(m=Max('updated_at'), c=Count('id'))
+            cache_key = f"expmap:clusters:{zoom}:{snapshot['m'].isoformat() if snapshot['m'] else ''}:{snapshot['c']}"
+            try:
+                clusters = cache.get(cache_key)
+            except Exception as e:
+                logger.warning(f"Cluster cache unavailable: {e}")
+                clusters = None
+
+            if clusters is None:
+                latlngs = list(expeditions.values_list(
+                    'destination__latitude', 'destination__longitude'
+                ).iterator(chunk_size=MAP_FETCH_CHUNK_SIZE))
+                clusters = cluster_points(latlngs, zoom)
+                try:
+                    cache.set(cache_key, clusters, timeout=CLUSTER_CACHE_TIMEOUT)
+                except Exception as e:
+                    logger.warning(f"Failed to cache clusters: {e}")
+
+            return Response({
+                'zoom': zoom,
+                'clusters': clusters,
+                'total_count': snapshot['c']
+            })
+
+        except Exception as e:
+            logger.error(f"Failed to get map clusters: {e}")
+            return Response({'error': 'Failed to load map clusters'}, status=500)
+
+
+STATUT_MARKER_COLORS = {
+    'en_transit': 'blue',
+    'tri': 'orange',
+    'livraison': 'red',
+    'livre': 'green',
+    'echec': 'black'
+}
+MAP_MARKER_COLORS = ['blue', 'orange', 'red', 'green', 'black', 'gray']
+
+# Per-status marker color index and escaped popup label, resolved once instead of per row
+_STATUT_MARKER = {
+    statut: (MAP_MARKER_COLORS.index(STATUT_MARKER_COLORS.get(statut, 'gray')), escape(label))
+    for statut, label in Expedition.STATUT_CHOICES
+}
+_DEFAULT_MARKER = (MAP_MARKER_COLORS.index('gray'), '')
+
+MAP_MARKER_CALLBACK = """
+function (row) {
+    var colors = %s;
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.setIcon(L.AwesomeMarkers.icon({icon: 'info-sign', prefix: 'glyphicon', markerColor: colors[row[2]]}));
+    marker.bindPopup('<b>Expédition ' + row[3] + '</b><br>Client: ' + row[4] + '<br>Statut: ' + row[5] + '<br>Destination: ' + row[6]);
+    return marker;
+}
+""" % json.dumps(MAP_MARKER_COLORS)
+
+
+EXPEDITION_MAP_CACHE_TIMEOUT = 3600
+
+
+def generate_expedition_map_html(force_refresh=False):
     """Generate HTML for expedition map (for email reports)"""
+    # folium is only needed here, so it is not imported with the API views
+    import folium
+    from folium.plugins import FastMarkerCluster
+
     try:
+        # The rendered map only changes when an active expedition does
+        snapshot = Expedition.objects.filter(is_active=True).aggregate(m=Max('updated_at'), c=Count('id'))
+        cache_key = f"expmap:{snapshot['m'].isoformat() if snapshot['m'] else ''}:{snapshot['c']}"
+        if not force_refresh:
+            try:
+                html = cache.get(cache_key)
+            except Exception as e:
+                logger.warning(f"Expedition map cache unavailable: {e}")
+                html = None
+            if html is not None:
+                return html
+
         # Create base map
         m = folium.Map(location=[48.8566, 2.3522], zoom_start=6)  # Centered on France
 
-        # Get expedition data
+        # Get expedition data as plain rows
         expeditions = Expedition.objects.filter(
             is_active=True,
             destination__latitude__isnull=False
-        ).select_related('destination', 'client')
-
-        # Add markers
-        marker_cluster = MarkerCluster().add_to(m)
-
-        for exp in expeditions:
-            color = {
-                'en_transit': 'blue',
-                'tri': 'orange',
-                'livraison': 'red',
-                'livre': 'green',
-                'echec': 'black'
-            }.get(exp.statut, 'gray')
-
-            folium.Marker(
-                location=[exp.destination.latitude, exp.destination.longitude],
-                popup=f"""
-                <b>Expédition {exp.numero}</b><br>
-                Client: {exp.client.nom if exp.client else 'N/A'}<br>
-                Statut: {exp.get_statut_display()}<br>
-                Destination: {exp.destination.nom}
-                """,
-                icon=folium.Icon(color=color)
-            ).add_to(marker_cluster)
+        ).values_list(
+            'destination__latitude', 'destination__longitude', 'statut',
+            'numero', 'client__nom', 'destination__nom'
+        )
+
+        # Markers are built client-side from [lat, lng, color index, numero, client, statut, destination]
+        rows = []
+        for lat, lng, statut, numero, client_nom, destination_nom in expeditions.iterator(chunk_size=MAP_FETCH_CHUNK_SIZE):
+            color_index, statut_label = _STATUT_MARKER.get(statut, _DEFAULT_MARKER)
+            rows.append([lat, lng, color_index, numero, escape(client_nom or 'N/A'), statut_label, escape(destination_nom or '')])
+        FastMarkerCluster(data=rows, callback=MAP_MARKER_CALLBACK).add_to(m)
 
         # Add legend
         legend_html = '''
@@ -214,7 +325,12 @@ def generate_expedition_map_html():
         '''
         m.get_root().html.add_child(folium.Element(legend_html))
 
-        return m.get_root().render()
+        html = m.get_root().render()
+        try:
+            cache.set(cache_key, html, timeout=EXPEDITION_MAP_CACHE_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Failed to cache expedition map: {e}")
+        return html
 
     except Exception as e:
         logger.error(f"Failed to generate expedition map HTML: {e}")
@@ -267,29 +383,44 @@ class RouteOptimizationView(APIView):
         if not expeditions:
             return []
 
+        # Coordinates in radians, converted once; missing coordinates become NaN
+        lats = np.radians(np.array([
+            np.nan if exp.destination.latitude is None else exp.destination.latitude for exp in expeditions
+        ], dtype=np.float64))
+        lngs = np.radians(np.array([
+            np.nan if exp.destination.longitude is None else exp.destination.longitude for exp in expeditions
+        ], dtype=np.float64))
+
+        # Imported here so that loading the map views does not pull in numba
+        from apps.logistics.route_kernels import nearest_neighbor
+        if nearest_neighbor is not None:
+            # Compiled kernel, without the per-stop Python loop
+            return [expeditions[i] for i in nearest_neighbor(lats, lngs)]
+
         # Start with first expedition
-        route = [expeditions[0]]
-        remaining = expeditions[1:]
-
-        while remaining:
-            last = route[-1]
-            # Find nearest remaining expedition
-            nearest_idx = 0
-            min_distance = float('inf')
-
-            for i, exp in enumerate(remaining):
-                if exp.destination.latitude and exp.destination.longitude:
-                    distance = self._calculate_distance(
-                        last.destination.latitude, last.destination.longitude,
-                        exp.destination.latitude, exp.destination.longitude
-                    )
-                    if distance < min_distance:
-                        min_distance = distance
-                        nearest_idx = i
-
-            route.append(remaining.pop(nearest_idx))
-
-        return route
+        order = [0]
+        remaining = np.ones(len(expeditions), dtype=bool)
+        remaining[0] = False
+
+        while remaining.any():
+            current = order[-1]
+            # Distance to every stop at once
+            distances = self._fast_distance(lats[current], lngs[current], lats, lngs)
+            candidates = np.flatnonzero(remaining)
+            scores = np.nan_to_num(distances[candidates], nan=np.inf)
+            nearest = int(candidates[np.argmin(scores)])
+
+            order.append(nearest)
+            remaining[nearest] = False
+
+        return [expeditions[i] for i in order]
+
+    @staticmethod
+    def _fast_distance(lat1, lng1, lat2, lng2):
+        """Equirectangular distance in km between points given in radians (scalars or arrays), close to Haversine over short segments"""
+        x = (lng2 - lng1) * np.cos((lat1 + lat2) / 2)
+        y = lat2 - lat1
+        return 6371 * np.sqrt(x * x + y * y)
 
     def _calculate_distance(self, lat1, lng1, lat2, lng2):
         """Calculate distance between two points using Haversine formula"""
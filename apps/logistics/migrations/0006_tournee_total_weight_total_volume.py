@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-15 22:47
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_tournee_totals(apps, schema_editor):
+    Tournee = apps.get_model('logistics', 'Tournee')
+    Expedition = apps.get_model('logistics', 'Expedition')
+
+    def expedition_sum(field):
+        totals = Expedition.objects.filter(tournee=OuterRef('pk')).order_by().values('tournee').annotate(total=Sum(field)).values('total')
+        return Coalesce(Subquery(totals), Value(0), output_field=models.DecimalField(max_digits=10, decimal_places=2))
+
+    Tournee.objects.update(total_weight=expedition_sum('poids'), total_volume=expedition_sum('volume'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logistics', '0005_alter_expedition_statut'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tournee',
+            name='total_volume',
+            field=models.DecimalField(decimal_places=2, default=0, help_text='Volume total des expéditions (m3)', max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='tournee',
+            name='total_weight',
+            field=models.DecimalField(decimal_places=2, default=0, help_text='Poids total des expéditions (kg)', max_digits=10),
+        ),
+        migrations.RunPython(backfill_tournee_totals, migrations.RunPython.noop),
+    ]
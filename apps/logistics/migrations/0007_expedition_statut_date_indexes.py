@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-15 22:49
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+        ('logistics', '0006_tournee_total_weight_total_volume'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='expedition',
+            index=models.Index(fields=['statut', 'date_creation'], name='logistics_e_statut_2fc7b8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expedition',
+            index=models.Index(condition=models.Q(('statut', 'livre')), fields=['date_livraison'], name='exp_livre_partial'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-15 22:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+        ('logistics', '0007_expedition_statut_date_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='trackinglog',
+            name='logistics_t_expedit_89271c_idx',
+        ),
+        migrations.AddIndex(
+            model_name='trackinglog',
+            index=models.Index(fields=['expedition', '-date'], name='logistics_t_expedit_646cda_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations
+
+
+def create_numero_sequence(apps, schema_editor):
+    # Sequences are PostgreSQL-only; other backends keep deriving the number from the last id
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("CREATE SEQUENCE IF NOT EXISTS expedition_numero_seq;")
+    schema_editor.execute(
+        "SELECT setval('expedition_numero_seq', COALESCE("
+        "(SELECT MAX(SUBSTRING(numero FROM 4)::bigint) FROM logistics_expedition WHERE numero ~ '^EXP[0-9]+$'), 0"
+        ") + 1, false);"
+    )
+
+
+def drop_numero_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP SEQUENCE IF EXISTS expedition_numero_seq;")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logistics', '0008_trackinglog_expedition_date_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_numero_sequence, drop_numero_sequence),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-15 22:59
+
+from django.db import migrations, models
+
+
+TIME_IN_STATUS_SQL = """
+CREATE MATERIALIZED VIEW expedition_time_in_status AS
+SELECT id,
+       expedition_id,
+       new_status AS status,
+       "timestamp" AS entered_at,
+       LEAD("timestamp") OVER (PARTITION BY expedition_id ORDER BY "timestamp", id) - "timestamp" AS duration
+FROM logistics_expeditionstatushistory;
+CREATE UNIQUE INDEX expedition_time_in_status_id ON expedition_time_in_status (id);
+CREATE INDEX expedition_time_in_status_status ON expedition_time_in_status (status);
+"""
+
+
+def create_time_in_status_view(apps, schema_editor):
+    # Materialized views are PostgreSQL-only; other backends compute durations from the history table
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(TIME_IN_STATUS_SQL)
+
+
+def drop_time_in_status_view(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP MATERIALIZED VIEW IF EXISTS expedition_time_in_status;")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logistics', '0009_expedition_numero_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExpeditionTimeInStatus',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('status', models.CharField(max_length=20)),
+                ('entered_at', models.DateTimeField()),
+                ('duration', models.DurationField(null=True)),
+            ],
+            options={
+                'db_table': 'expedition_time_in_status',
+                'ordering': ['entered_at'],
+                'managed': False,
+            },
+        ),
+        migrations.RunPython(create_time_in_status_view, drop_time_in_status_view),
+    ]
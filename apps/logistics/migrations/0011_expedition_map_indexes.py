@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-15 23:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+        ('logistics', '0010_expedition_time_in_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='expedition',
+            index=models.Index(fields=['is_active', 'destination'], name='logistics_e_is_acti_0e5c86_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expedition',
+            index=models.Index(condition=models.Q(('statut', 'livre')), fields=['statut', 'destination'], name='exp_livre_dest_idx'),
+        ),
+    ]
@@ -1,5 +1,8 @@
 
-from django.db import models
+from django.db import connection, models
+from django.db.models import F, Max, OuterRef, Subquery
+from django.db.models.functions import Greatest
+from django.utils import timezone
 from django.core.validators import RegexValidator, MinValueValidator
 from apps.core.models import Client, Chauffeur, Vehicule, Destination, TypeService, Tarification
 from apps.users.models import User
@@ -38,20 +41,40 @@ class Expedition(models.Model):
 			models.Index(fields=['statut']),
 			models.Index(fields=['date_creation']),
 			models.Index(fields=['client']),
+			models.Index(fields=['statut', 'date_creation']),
+			models.Index(fields=['date_livraison'], name='exp_livre_partial', condition=models.Q(statut='livre')),
+			models.Index(fields=['is_active', 'destination']),
+			models.Index(fields=['statut', 'destination'], name='exp_livre_dest_idx', condition=models.Q(statut='livre')),
 		]
 		ordering = ['-date_creation']
 
 	def __str__(self):
 		return self.numero
 
+	@classmethod
+	def next_numero(cls):
+		"""Return the next EXP###### number, drawn from expedition_numero_seq on PostgreSQL"""
+		if connection.vendor == 'postgresql':
+			with connection.cursor() as cursor:
+				cursor.execute("SELECT nextval('expedition_numero_seq')")
+				next_value = cursor.fetchone()[0]
+		else:
+			last_id = cls.objects.aggregate(last_id=Max('id'))['last_id']
+			next_value = (last_id or 0) + 1
+		return f"EXP{next_value:06d}"
+
 
 class Tournee(models.Model):
+	KM_PER_EXPEDITION = 50  # Estimated distance added by each expedition
+
 	date = models.DateField()
 	chauffeur = models.ForeignKey(Chauffeur, on_delete=models.CASCADE)
 	vehicule = models.ForeignKey(Vehicule, on_delete=models.CASCADE)
 	kilometrage = models.DecimalField(max_digits=8, decimal_places=2, validators=[MinValueValidator(0)])
 	duree = models.DurationField()
 	consommation = models.DecimalField(max_digits=8, decimal_places=2, validators=[MinValueValidator(0)])
+	total_weight = models.DecimalField(max_digits=10, decimal_places=2, default=0, help_text="Poids total des expéditions (kg)")
+	total_volume = models.DecimalField(max_digits=10, decimal_places=2, default=0, help_text="Volume total des expéditions (m3)")
 	incidents = models.TextField(blank=True)
 	created_at = models.DateTimeField(auto_now_add=True)
 	updated_at = models.DateTimeField(auto_now=True)
@@ -68,6 +91,31 @@ class Tournee(models.Model):
 	def __str__(self):
 		return f"Tournee {self.id} - {self.date}"
 
+	@classmethod
+	def apply_expedition_totals(cls, tournee_id, expedition_id, removed=False):
+		"""Add (or remove) one expedition to the running totals of a tour in a single UPDATE"""
+		expedition = Expedition.objects.filter(pk=expedition_id)
+		weight = Subquery(expedition.values('poids')[:1])
+		volume = Subquery(expedition.values('volume')[:1])
+		vehicule_consommation = Subquery(Vehicule.objects.filter(pk=OuterRef('vehicule')).values('consommation')[:1])
+
+		if removed:
+			kilometrage = Greatest(F('kilometrage') - cls.KM_PER_EXPEDITION, 0)
+			total_weight = Greatest(F('total_weight') - weight, 0)
+			total_volume = Greatest(F('total_volume') - volume, 0)
+		else:
+			kilometrage = F('kilometrage') + cls.KM_PER_EXPEDITION
+			total_weight = F('total_weight') + weight
+			total_volume = F('total_volume') + volume
+
+		return cls.objects.filter(pk=tournee_id).update(
+			kilometrage=kilometrage,
+			consommation=kilometrage * vehicule_consommation / 100,
+			total_weight=total_weight,
+			total_volume=total_volume,
+			updated_at=timezone.now()
+		)
+
 
 class TrackingLog(models.Model):
 	expedition = models.ForeignKey(Expedition, on_delete=models.CASCADE, related_name='trackings')
@@ -82,7 +130,7 @@ class TrackingLog(models.Model):
 
 	class Meta:
 		indexes = [
-			models.Index(fields=['expedition']),
+			models.Index(fields=['expedition', '-date']),
 			models.Index(fields=['date']),
 			models.Index(fields=['statut']),
 		]
@@ -153,6 +201,23 @@ class ExpeditionStatusHistory(models.Model):
 		return f'{self.expedition.numero}: {self.old_status} -> {self.new_status}'
 
 
+class ExpeditionTimeInStatus(models.Model):
+	"""Read-only mapping of the expedition_time_in_status materialized view (PostgreSQL only)"""
+	id = models.BigIntegerField(primary_key=True)
+	expedition = models.ForeignKey(Expedition, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+	status = models.CharField(max_length=20)
+	entered_at = models.DateTimeField()
+	duration = models.DurationField(null=True)
+
+	class Meta:
+		managed = False
+		db_table = 'expedition_time_in_status'
+		ordering = ['entered_at']
+
+	def __str__(self):
+		return f"{self.expedition_id} {self.status}: {self.duration}"
+
+
 class ActionHistory(models.Model):
 	"""Historique des actions sur les expéditions"""
 	ACTION_CHOICES = [
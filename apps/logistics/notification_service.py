@@ -2,23 +2,71 @@
 Notification service for creating and sending notifications
 """
 import logging
+from django.core.cache import cache
 from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage, get_connection, send_mail
 from django.conf import settings
-from twilio.rest import Client
 from apps.logistics.models import Notification, Expedition
 from apps.support.models import Incident
+from apps.logistics.tasks import dispatch_notification, dispatch_notification_batch
 from apps.users.models import User
 
 logger = logging.getLogger(__name__)
 
+# Notifications whose email and SMS are sent by one Celery task
+NOTIFICATION_DISPATCH_BATCH_SIZE = 100
+
+# Ids of the admin/management users notified of operational events, shared by all workers through the cache
+ADMIN_IDS_CACHE_KEY = 'notif:admin_ids'
+ADMIN_IDS_TTL = 300
+
+
+def get_admin_recipient_ids():
+    """Return the ids of admin and management users"""
+    try:
+        ids = cache.get(ADMIN_IDS_CACHE_KEY)
+    except Exception as e:
+        logger.warning(f"Admin recipient cache unavailable: {e}")
+        ids = None
+    if ids is None:
+        ids = list(User.objects.filter(Q(role='admin') | Q(department='management')).values_list('id', flat=True))
+        try:
+            cache.set(ADMIN_IDS_CACHE_KEY, ids, ADMIN_IDS_TTL)
+        except Exception as e:
+            logger.warning(f"Failed to cache admin recipients: {e}")
+    return ids
+
+
+@receiver([post_save, post_delete], sender=User)
+def clear_admin_recipient_ids(**kwargs):
+    """Drop the cached admin ids when a user changes"""
+    try:
+        cache.delete(ADMIN_IDS_CACHE_KEY)
+    except Exception as e:
+        logger.warning(f"Failed to invalidate admin recipient cache: {e}")
+
+
+_twilio = None
+
+
+def get_twilio_client():
+    """Return the shared Twilio client, created on first use"""
+    global _twilio
+    if _twilio is None:
+        # Imported here so workers that never send SMS don't load the Twilio SDK
+        from twilio.rest import Client as TwilioClient
+        _twilio = TwilioClient(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+    return _twilio
+
 
 class NotificationService:
     """Service for creating and managing notifications"""
     
     @staticmethod
-    def create_notification(title, message, category, type='info', user=None, client=None, send_email=False):
+    def create_notification(title, message, category, type='info', user=None, client=None, send_email=False, batch=None):
         """
         Create a notification
         
@@ -30,8 +78,9 @@ class NotificationService:
             user: User to notify (optional)
             client: Client to notify (optional)
             send_email: Whether to send email notification
+            batch: List collecting unsaved notifications for a later bulk_create (optional)
         """
-        notification = Notification.objects.create(
+        notification = Notification(
             title=title,
             message=message,
             category=category,
@@ -40,9 +89,17 @@ class NotificationService:
             client=client,
             sent_via_email=send_email
         )
+        if batch is not None:
+            # Saved, and its email queued, by the caller once the batch is complete
+            batch.append(notification)
+            return notification
+        notification.save()
         
-        # TODO: Send email if send_email is True
-        # This would integrate with Django's email backend
+        if send_email:
+            try:
+                dispatch_notification.delay(notification.id)
+            except Exception as e:
+                logger.error(f"Failed to queue notification {notification.id}: {e}")
         
         return notification
     
@@ -52,6 +109,8 @@ class NotificationService:
         title = f"Expédition {expedition.numero} - Changement de statut"
         message = f"Le statut de votre expédition est passé de '{old_status}' à '{new_status}'."
         
+        notifications = []
+        
         # Notify client
         if expedition.client:
             NotificationService.create_notification(
@@ -60,19 +119,44 @@ class NotificationService:
                 category='expedition',
                 type='info',
                 client=expedition.client,
-                send_email=True
+                send_email=True,
+                batch=notifications
             )
         
         # Notify admins and management
-        admins = User.objects.filter(Q(role='admin') | Q(department='management'))
-        for admin in admins:
-            NotificationService.create_notification(
+        notifications.extend(
+            Notification(
                 title=title,
                 message=f"{message} (Client: {expedition.client})",
                 category='expedition',
                 type='info',
-                user=admin
+                user_id=admin_id
+            )
+            for admin_id in get_admin_recipient_ids()
+        )
+        Notification.objects.bulk_create(notifications, batch_size=500)
+        NotificationService.queue_dispatch(notifications)
+
+    @staticmethod
+    def notify_bulk_status_change(expedition_ids, new_status):
+        """
+        Notify admins once about a batch of expeditions moved to new_status by a queryset update
+
+        Used instead of one notify_expedition_status_change per row, which those updates skip.
+        """
+        if not expedition_ids:
+            return
+        count = len(expedition_ids)
+        Notification.objects.bulk_create([
+            Notification(
+                title="Mise à jour groupée des expéditions",
+                message=f"{count} expédition(s) sont passées au statut '{new_status}'.",
+                category='expedition',
+                type='info',
+                user_id=admin_id
             )
+            for admin_id in get_admin_recipient_ids()
+        ], batch_size=500)
     
     @staticmethod
     def notify_incident_created(incident):
@@ -81,6 +165,8 @@ class NotificationService:
         message = f"Un incident de type '{incident.get_type_display()}' a été signalé. "
         message += f"Priorité: {incident.get_priorite_display()}, Sévérité: {incident.get_severite_display()}."
         
+        notifications = []
+        
         # Notify relevant client if expedition is associated
         if incident.expedition and incident.expedition.client:
             NotificationService.create_notification(
@@ -90,20 +176,24 @@ class NotificationService:
                 category='incident',
                 type='warning',
                 client=incident.expedition.client,
-                send_email=True
+                send_email=True,
+                batch=notifications
             )
         
         # Notify admins and management
-        admins = User.objects.filter(Q(role='admin') | Q(department='management'))
-        for admin in admins:
-            NotificationService.create_notification(
+        notifications.extend(
+            Notification(
                 title=title,
                 message=message,
                 category='incident',
                 type='warning' if incident.severite in ['elevee', 'critique'] else 'info',
-                user=admin,
-                send_email=(incident.severite == 'critique')
+                user_id=admin_id,
+                sent_via_email=(incident.severite == 'critique')
             )
+            for admin_id in get_admin_recipient_ids()
+        )
+        Notification.objects.bulk_create(notifications, batch_size=500)
+        NotificationService.queue_dispatch(notifications)
     
     @staticmethod
     def notify_incident_resolved(incident):
@@ -111,6 +201,8 @@ class NotificationService:
         title = f"Incident résolu - {incident.get_type_display()}"
         message = f"L'incident a été résolu. Détails: {incident.resolution_details}"
         
+        notifications = []
+        
         # Notify client if applicable
         if incident.expedition and incident.expedition.client:
             NotificationService.create_notification(
@@ -119,19 +211,23 @@ class NotificationService:
                 category='incident',
                 type='success',
                 client=incident.expedition.client,
-                send_email=True
+                send_email=True,
+                batch=notifications
             )
         
         # Notify admins
-        admins = User.objects.filter(Q(role='admin') | Q(department='management'))
-        for admin in admins:
-            NotificationService.create_notification(
+        notifications.extend(
+            Notification(
                 title=title,
                 message=message,
                 category='incident',
                 type='success',
-                user=admin
+                user_id=admin_id
             )
+            for admin_id in get_admin_recipient_ids()
+        )
+        Notification.objects.bulk_create(notifications, batch_size=500)
+        NotificationService.queue_dispatch(notifications)
     
     @staticmethod
     def notify_delivery_delayed(expedition):
@@ -152,7 +248,7 @@ class NotificationService:
     @staticmethod
     def get_user_notifications(user, unread_only=False):
         """Get notifications for a user"""
-        queryset = Notification.objects.filter(user=user)
+        queryset = Notification.objects.filter(user=user).select_related('user')
         if unread_only:
             queryset = queryset.filter(read=False)
         return queryset
@@ -160,7 +256,7 @@ class NotificationService:
     @staticmethod
     def get_client_notifications(client, unread_only=False):
         """Get notifications for a client"""
-        queryset = Notification.objects.filter(client=client)
+        queryset = Notification.objects.filter(client=client).select_related('client')
         if unread_only:
             queryset = queryset.filter(read=False)
         return queryset
@@ -170,7 +266,7 @@ class NotificationService:
         """Mark a notification as read"""
         try:
             notification = Notification.objects.get(id=notification_id)
-            if user and notification.user != user:
+            if user and notification.user_id != user.pk:
                 return False
             notification.read = True
             notification.read_at = timezone.now()
@@ -208,6 +304,55 @@ class NotificationService:
             logger.error(f"Failed to send email for notification {notification.id}: {e}")
             return False
 
+    @staticmethod
+    def queue_dispatch(notifications):
+        """
+        Hand freshly created notifications to Celery, NOTIFICATION_DISPATCH_BATCH_SIZE per task
+
+        They go out over the same channels (email and SMS) as a single notification queued by create_notification.
+        """
+        ids = [n.id for n in notifications if n.sent_via_email and n.id]
+        for start in range(0, len(ids), NOTIFICATION_DISPATCH_BATCH_SIZE):
+            batch = ids[start:start + NOTIFICATION_DISPATCH_BATCH_SIZE]
+            try:
+                dispatch_notification_batch.delay(batch)
+            except Exception as e:
+                logger.error(f"Failed to queue notifications {batch}: {e}")
+
+    @staticmethod
+    def send_bulk_email(notifications):
+        """Send the emails of several notifications over a single SMTP connection"""
+        notifications = [n for n in notifications if n.sent_via_email]
+        if not notifications:
+            return 0
+
+        user_ids = {n.user_id for n in notifications if n.user_id}
+        user_emails = dict(User.objects.filter(id__in=user_ids).values_list('id', 'email')) if user_ids else {}
+
+        messages = []
+        for notification in notifications:
+            if notification.user_id:
+                recipient_email = user_emails.get(notification.user_id)
+            else:
+                recipient_email = notification.client.email if notification.client else None
+            if recipient_email:
+                messages.append(EmailMessage(
+                    subject=notification.title,
+                    body=notification.message,
+                    from_email=settings.DEFAULT_FROM_EMAIL,
+                    to=[recipient_email],
+                ))
+
+        if not messages:
+            return 0
+        try:
+            sent = get_connection(fail_silently=True).send_messages(messages) or 0
+            logger.info(f"Sent {sent} notification emails")
+            return sent
+        except Exception as e:
+            logger.error(f"Failed to send notification emails: {e}")
+            return 0
+
     @staticmethod
     def send_sms_notification(notification, phone_number=None):
         """Send SMS notification"""
@@ -219,11 +364,15 @@ class NotificationService:
                     phone_number = notification.client.telephone
 
             if phone_number and hasattr(settings, 'TWILIO_ACCOUNT_SID'):
-                client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-                message = client.messages.create(
+                messaging_service_sid = getattr(settings, 'TWILIO_MESSAGING_SERVICE_SID', None)
+                if messaging_service_sid:
+                    sender = {'messaging_service_sid': messaging_service_sid}
+                else:
+                    sender = {'from_': settings.TWILIO_PHONE_NUMBER}
+                message = get_twilio_client().messages.create(
                     body=f"{notification.title}: {notification.message}",
-                    from_=settings.TWILIO_PHONE_NUMBER,
-                    to=phone_number
+                    to=phone_number,
+                    **sender
                 )
                 logger.info(f"SMS sent to {phone_number} for notification {notification.id}")
                 return True
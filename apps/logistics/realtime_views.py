@@ -4,10 +4,18 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from django.utils import timezone
 from datetime import timedelta
-from django.db.models import Q
+from django.db.models import Count, Exists, OuterRef, Q, Subquery
+from apps.core.models import Chauffeur
 from .models import Expedition, TrackingLog
 from .serializers import ExpeditionSerializer, TrackingLogSerializer
 
+# Simulated positions per status - in a real implementation these would be GPS coordinates
+_STATUS_LOCATIONS = {
+    'tri': {'name': 'Distribution Center', 'coordinates': {'lat': 48.8566, 'lng': 2.3522}},
+    'en_transit': {'name': 'En route to destination', 'coordinates': {'lat': 48.8606, 'lng': 2.3376}},
+    'livraison': {'name': 'Near delivery location', 'coordinates': {'lat': 48.8647, 'lng': 2.3490}},
+}
+
 
 class RealTimeTrackingViewSet(viewsets.ViewSet):
     """
@@ -20,9 +28,18 @@ class RealTimeTrackingViewSet(viewsets.ViewSet):
         """
         Get all currently active expeditions with real-time status
         """
+        self._now = timezone.now()
+        self._ts_iso = self._now.isoformat()
+        # Latest tracking log of each expedition, fetched in the same query
+        last_logs = TrackingLog.objects.filter(expedition=OuterRef('pk')).order_by('-date')
         active_expeditions = Expedition.objects.filter(
             Q(statut__in=['en_transit', 'livraison']) & Q(is_active=True)
-        ).select_related('client', 'destination', 'type_service')
+        ).select_related(
+            'client', 'destination', 'type_service', 'tournee__chauffeur', 'tournee__vehicule'
+        ).annotate(
+            last_lieu=Subquery(last_logs.values('lieu')[:1]),
+            last_date=Subquery(last_logs.values('date')[:1])
+        )
 
         # Add real-time location data (simulated for now)
         expeditions_data = []
@@ -39,7 +56,7 @@ class RealTimeTrackingViewSet(viewsets.ViewSet):
         return Response({
             'count': len(expeditions_data),
             'results': expeditions_data,
-            'timestamp': timezone.now().isoformat()
+            'timestamp': self._ts_iso
         })
 
     @action(detail=True, methods=['get'])
@@ -47,6 +64,8 @@ class RealTimeTrackingViewSet(viewsets.ViewSet):
         """
         Get live tracking data for a specific expedition
         """
+        now = timezone.now()
+        self._ts_iso = now.isoformat()
         try:
             expedition = Expedition.objects.get(pk=pk, is_active=True)
         except Expedition.DoesNotExist:
@@ -55,17 +74,17 @@ class RealTimeTrackingViewSet(viewsets.ViewSet):
         # Get recent tracking logs
         recent_logs = TrackingLog.objects.filter(
             expedition=expedition
-        ).order_by('-date')[:10]
+        ).select_related('expedition', 'chauffeur').order_by('-date')[:10]
 
         # Current location simulation
-        current_location = self._simulate_current_location(expedition)
+        current_location = self._simulate_current_location(expedition.statut)
 
         return Response({
             'expedition': ExpeditionSerializer(expedition).data,
             'current_location': current_location,
             'tracking_history': TrackingLogSerializer(recent_logs, many=True).data,
-            'next_update': (timezone.now() + timedelta(seconds=30)).isoformat(),
-            'timestamp': timezone.now().isoformat()
+            'next_update': (now + timedelta(seconds=30)).isoformat(),
+            'timestamp': self._ts_iso
         })
 
     @action(detail=False, methods=['get'])
@@ -73,46 +92,40 @@ class RealTimeTrackingViewSet(viewsets.ViewSet):
         """
         Get real-time locations of all active drivers
         """
+        self._ts_iso = timezone.now().isoformat()
         # This would integrate with GPS tracking system
         # For now, return mock data based on active tournees
 
-        from apps.core.models import Chauffeur
-        from django.db.models import Exists, OuterRef
-
-        # Find drivers with active tournees
+        # Find drivers with active tournees, along with their current expedition
+        current_expeditions = Expedition.objects.filter(
+            tournee__chauffeur=OuterRef('pk'),
+            statut__in=['en_transit', 'livraison']
+        ).order_by('-date_creation')
         active_drivers = Chauffeur.objects.filter(
             is_active=True
-        ).filter(
-            Exists(
-                Expedition.objects.filter(
-                    tournee__chauffeur=OuterRef('pk'),
-                    statut__in=['en_transit', 'livraison']
-                )
-            )
+        ).annotate(
+            current_expedition_numero=Subquery(current_expeditions.values('numero')[:1]),
+            current_expedition_statut=Subquery(current_expeditions.values('statut')[:1])
+        ).filter(current_expedition_numero__isnull=False).values(
+            'id', 'nom', 'prenom', 'current_expedition_numero', 'current_expedition_statut'
         )
 
-        driver_locations = []
-        for driver in active_drivers:
-            # Get current expedition for this driver
-            current_expedition = Expedition.objects.filter(
-                tournee__chauffeur=driver,
-                statut__in=['en_transit', 'livraison']
-            ).first()
-
-            if current_expedition:
-                driver_locations.append({
-                    'driver_id': driver.id,
-                    'driver_name': f"{driver.nom} {driver.prenom}",
-                    'current_expedition': current_expedition.numero,
-                    'location': self._simulate_current_location(current_expedition),
-                    'status': 'active',
-                    'last_update': timezone.now().isoformat()
-                })
+        driver_locations = [
+            {
+                'driver_id': driver['id'],
+                'driver_name': f"{driver['nom']} {driver['prenom']}",
+                'current_expedition': driver['current_expedition_numero'],
+                'location': self._simulate_current_location(driver['current_expedition_statut']),
+                'status': 'active',
+                'last_update': self._ts_iso
+            }
+            for driver in active_drivers
+        ]
 
         return Response({
             'count': len(driver_locations),
             'drivers': driver_locations,
-            'timestamp': timezone.now().isoformat()
+            'timestamp': self._ts_iso
         })
 
     @action(detail=False, methods=['post'])
@@ -151,13 +164,11 @@ class RealTimeTrackingViewSet(viewsets.ViewSet):
 
     def _get_realtime_info(self, expedition):
         """
-        Get real-time information for an expedition
+        Get real-time information for an expedition annotated with last_lieu/last_date
         """
-        last_log = TrackingLog.objects.filter(expedition=expedition).order_by('-date').first()
-
         return {
-            'last_known_location': last_log.lieu if last_log else 'Unknown',
-            'last_update': last_log.date.isoformat() if last_log else None,
+            'last_known_location': expedition.last_lieu if expedition.last_date else 'Unknown',
+            'last_update': expedition.last_date.isoformat() if expedition.last_date else None,
             'driver_assigned': expedition.tournee.chauffeur.nom + ' ' + expedition.tournee.chauffeur.prenom if expedition.tournee else None,
             'vehicle_assigned': expedition.tournee.vehicule.immatriculation if expedition.tournee else None,
         }
@@ -177,35 +188,27 @@ class RealTimeTrackingViewSet(viewsets.ViewSet):
         }
 
         days_to_add = base_days.get(expedition.statut, 1)
-        eta = timezone.now() + timedelta(days=days_to_add)
+        eta = self._now + timedelta(days=days_to_add)
 
         return eta.isoformat()
 
     def _get_last_update(self, expedition):
         """
-        Get timestamp of last update
+        Get timestamp of last update of an expedition annotated with last_date
         """
-        last_log = TrackingLog.objects.filter(expedition=expedition).order_by('-date').first()
-        return last_log.date.isoformat() if last_log else expedition.date_creation.isoformat()
+        return expedition.last_date.isoformat() if expedition.last_date else expedition.date_creation.isoformat()
 
-    def _simulate_current_location(self, expedition):
+    def _simulate_current_location(self, statut):
         """
         Simulate current location based on expedition status
         In production, this would come from GPS tracking
         """
-        # This is a simulation - in real implementation, you'd have GPS coordinates
-        status_locations = {
-            'tri': {'name': 'Distribution Center', 'coordinates': {'lat': 48.8566, 'lng': 2.3522}},
-            'en_transit': {'name': 'En route to destination', 'coordinates': {'lat': 48.8606, 'lng': 2.3376}},
-            'livraison': {'name': 'Near delivery location', 'coordinates': {'lat': 48.8647, 'lng': 2.3490}},
-        }
-
-        location_info = status_locations.get(expedition.statut, status_locations['tri'])
+        location_info = _STATUS_LOCATIONS.get(statut, _STATUS_LOCATIONS['tri'])
 
         return {
             'name': location_info['name'],
             'coordinates': location_info['coordinates'],
-            'timestamp': timezone.now().isoformat(),
+            'timestamp': self._ts_iso,
             'accuracy': 'high'  # GPS accuracy level
         }
 
@@ -216,23 +219,22 @@ def tracking_dashboard(request):
     """
     Get comprehensive real-time tracking dashboard data
     """
-    # Overall statistics
-    total_active = Expedition.objects.filter(
-        Q(statut__in=['en_transit', 'livraison']) & Q(is_active=True)
-    ).count()
-
-    delivered_today = Expedition.objects.filter(
-        date_livraison__date=timezone.now().date(),
-        statut='livre'
-    ).count()
+    # Overall statistics in a single aggregate
+    totals = Expedition.objects.aggregate(
+        active=Count('pk', filter=Q(statut__in=['en_transit', 'livraison'], is_active=True)),
+        delivered_today=Count('pk', filter=Q(date_livraison__date=timezone.now().date(), statut='livre')),
+        total=Count('pk', filter=Q(is_active=True))
+    )
 
     # Status breakdown
     status_counts = Expedition.objects.filter(is_active=True).values('statut').annotate(
         count=Count('statut')
     )
 
-    # Recent updates (last 10 tracking logs)
-    recent_updates = TrackingLog.objects.select_related('expedition').order_by('-date')[:10]
+    # Recent updates (last 10 tracking logs) as plain rows
+    recent_updates = TrackingLog.objects.values(
+        'expedition__numero', 'statut', 'lieu', 'date', 'chauffeur__nom', 'chauffeur__prenom'
+    ).order_by('-date')[:10]
 
     # Active drivers count
     from apps.core.models import Chauffeur
@@ -247,19 +249,19 @@ def tracking_dashboard(request):
 
     dashboard_data = {
         'summary': {
-            'active_expeditions': total_active,
-            'delivered_today': delivered_today,
+            'active_expeditions': totals['active'],
+            'delivered_today': totals['delivered_today'],
             'active_drivers': active_drivers,
-            'total_expeditions': Expedition.objects.filter(is_active=True).count()
+            'total_expeditions': totals['total']
         },
         'status_breakdown': {item['statut']: item['count'] for item in status_counts},
         'recent_updates': [
             {
-                'expedition': log.expedition.numero,
-                'status': log.statut,
-                'location': log.lieu,
-                'timestamp': log.date.isoformat(),
-                'driver': f"{log.chauffeur.nom} {log.chauffeur.prenom}" if log.chauffeur else None
+                'expedition': log['expedition__numero'],
+                'status': log['statut'],
+                'location': log['lieu'],
+                'timestamp': log['date'].isoformat(),
+                'driver': f"{log['chauffeur__nom']} {log['chauffeur__prenom']}" if log['chauffeur__nom'] is not None else None
             }
             for log in recent_updates
         ],
@@ -0,0 +1,46 @@
+"""
+Compiled kernels for route optimization on large tournees (requires numba)
+"""
+import math
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba has no wheels yet for every Python release
+    njit = None
+
+
+def _nearest_neighbor(lats, lngs):
+    """
+    Nearest-neighbor route starting from the first stop, on coordinates in radians
+
+    Ranks stops with the same equirectangular distance as RouteOptimizationView._fast_distance;
+    missing (NaN) coordinates count as infinitely far.
+    """
+    n = lats.size
+    route = np.empty(n, np.int64)
+    visited = np.zeros(n, np.bool_)
+    route[0] = 0
+    visited[0] = True
+    for k in range(1, n):
+        current = route[k - 1]
+        best = -1
+        best_distance = np.inf
+        for j in range(n):
+            if visited[j]:
+                continue
+            x = (lngs[j] - lngs[current]) * math.cos((lats[current] + lats[j]) * 0.5)
+            y = lats[j] - lats[current]
+            distance = x * x + y * y
+            if math.isnan(distance):
+                distance = np.inf
+            if best == -1 or distance < best_distance:
+                best = j
+                best_distance = distance
+        route[k] = best
+        visited[best] = True
+    return route
+
+
+nearest_neighbor = njit(cache=True)(_nearest_neighbor) if njit else None
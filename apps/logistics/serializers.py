@@ -2,7 +2,7 @@ from decimal import Decimal
 from rest_framework import serializers
 from django.utils.translation import gettext_lazy as _
 from .models import Expedition, Tournee, TrackingLog
-from apps.core.models import Tarification
+from utils.calculators import get_tariff_matrix
 
 class ExpeditionSerializer(serializers.ModelSerializer):
     client_nom = serializers.CharField(source='client.nom', read_only=True)
@@ -22,17 +22,13 @@ class ExpeditionSerializer(serializers.ModelSerializer):
         poids = data.get('poids') or Decimal('0')
         volume = data.get('volume') or Decimal('0')
 
-        try:
-            tarification = Tarification.objects.get(
-                type_service=data['type_service'],
-                destination=data['destination']
-            )
-            montant = (Decimal(poids) * tarification.tarif_poids) + (Decimal(volume) * tarification.tarif_volume)
-            data['montant'] = montant
-        except Tarification.DoesNotExist:
+        tarif = get_tariff_matrix().get((data['type_service'].pk, data['destination'].pk))
+        if tarif is not None:
+            tarif_poids, tarif_volume = tarif
+            data['montant'] = (Decimal(poids) * tarif_poids) + (Decimal(volume) * tarif_volume)
+        elif 'montant' not in data or data['montant'] in (None, ''):
             # If caller provided a montant, accept it; otherwise raise validation error
-            if 'montant' not in data or data['montant'] in (None, ''):
-                raise serializers.ValidationError(_("No pricing found for this service type and destination."))
+            raise serializers.ValidationError(_("No pricing found for this service type and destination."))
         return data
 
     def validate_numero(self, value):
@@ -40,6 +36,11 @@ class ExpeditionSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError(_("An expedition with this number already exists."))
         return value
 
+class ExpeditionStatusChangeSerializer(serializers.Serializer):
+    """One entry of the changes list posted to ExpeditionViewSet.bulk_update_status"""
+    id = serializers.IntegerField(min_value=1)
+    statut = serializers.ChoiceField(choices=Expedition.STATUT_CHOICES)
+
 class TourneeSerializer(serializers.ModelSerializer):
     chauffeur_nom = serializers.CharField(source='chauffeur.nom', read_only=True)
     chauffeur_prenom = serializers.CharField(source='chauffeur.prenom', read_only=True)
@@ -48,10 +49,13 @@ class TourneeSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Tournee
-        fields = ['id', 'date', 'chauffeur', 'chauffeur_nom', 'chauffeur_prenom', 'vehicule', 'vehicule_immatriculation', 'kilometrage', 'duree', 'consommation', 'incidents', 'expedition_count', 'created_at', 'updated_at', 'is_active']
-        read_only_fields = ['created_at', 'updated_at']
+        fields = ['id', 'date', 'chauffeur', 'chauffeur_nom', 'chauffeur_prenom', 'vehicule', 'vehicule_immatriculation', 'kilometrage', 'duree', 'consommation', 'total_weight', 'total_volume', 'incidents', 'expedition_count', 'created_at', 'updated_at', 'is_active']
+        read_only_fields = ['total_weight', 'total_volume', 'created_at', 'updated_at']
 
     def get_expedition_count(self, obj):
+        # Use the count annotated by TourneeViewSet when present
+        if hasattr(obj, 'expedition_count'):
+            return obj.expedition_count
         return obj.expeditions.count()
 
     def validate(self, data):
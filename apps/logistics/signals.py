@@ -2,7 +2,11 @@ from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.utils import timezone
+from decimal import Decimal
 from django.db import models
+from django.db.models import Case, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import GreaterThan
 from .models import Expedition, Tournee, ExpeditionStatusHistory
 from apps.support.models import Incident
 from apps.billing.models import Facture, Paiement
@@ -20,9 +24,9 @@ def expedition_pre_save(sender, instance, **kwargs):
     """Log expedition changes and track status changes"""
     if instance.pk:
         try:
-            old_instance = Expedition.objects.get(pk=instance.pk)
+            old_instance = Expedition.objects.only('statut').get(pk=instance.pk)
             if old_instance.statut != instance.statut:
-                logger.info(f"Expedition {instance.numero} status changed from {old_instance.statut} to {instance.statut}")
+                logger.info("Expedition %s status changed from %s to %s", instance.numero, old_instance.statut, instance.statut)
                 
                 # Create status history record
                 ExpeditionStatusHistory.objects.create(
@@ -44,36 +48,61 @@ def expedition_pre_save(sender, instance, **kwargs):
 @receiver(post_save, sender=Expedition)
 def expedition_post_save(sender, instance, created, **kwargs):
     """Handle expedition creation and updates"""
+    if not logger.isEnabledFor(logging.INFO):
+        # Skip loading the client just to build a discarded message
+        return
     if created:
-        logger.info(f"New expedition created: {instance.numero} for client {instance.client}")
+        logger.info("New expedition created: %s for client %s", instance.numero, instance.client)
     else:
-        logger.info(f"Expedition updated: {instance.numero}")
+        logger.info("Expedition updated: %s", instance.numero)
 
 @receiver(post_save, sender=Tournee)
 def tournee_post_save(sender, instance, created, **kwargs):
     """Calculate tour totals when saved"""
-    if created or instance.expeditions.exists():
-        # Recalculate totals
-        expeditions = instance.expeditions.all()
-        total_weight = sum(exp.poids for exp in expeditions)
-        total_volume = sum(exp.volume for exp in expeditions)
-
-        # Update if changed
-        if instance.kilometrage == 0:  # Only auto-calculate if not set
-            # Simple calculation based on number of expeditions
-            instance.kilometrage = len(expeditions) * 50  # 50km per expedition average
-
-        if instance.consommation == 0:
-            # Calculate based on vehicle consumption and distance
-            instance.consommation = (instance.kilometrage * instance.vehicule.consommation) / 100
-
-        instance.save(update_fields=['kilometrage', 'consommation'])
+    if not created and instance.kilometrage and instance.consommation:
+        # Nothing left to auto-calculate; running totals are kept by Tournee.apply_expedition_totals
+        return
+
+    # Recalculate totals in one aggregate query
+    totals = instance.expeditions.aggregate(
+        total_weight=models.Sum('poids'),
+        total_volume=models.Sum('volume'),
+        count=models.Count('id')
+    )
+    if not created and not totals['count']:
+        return
+
+    updates = {
+        'total_weight': totals['total_weight'] or 0,
+        'total_volume': totals['total_volume'] or 0,
+    }
+    if instance.kilometrage == 0:  # Only auto-calculate if not set
+        # Simple calculation based on number of expeditions
+        updates['kilometrage'] = totals['count'] * Tournee.KM_PER_EXPEDITION
+
+    if instance.consommation == 0:
+        # Calculate based on vehicle consumption and distance
+        updates['consommation'] = (updates.get('kilometrage', instance.kilometrage) * instance.vehicule.consommation) / 100
+
+    # update() writes the row without sending post_save again
+    Tournee.objects.filter(pk=instance.pk).update(**updates)
+    for field, value in updates.items():
+        setattr(instance, field, value)
+
+@receiver(pre_save, sender=Incident)
+def incident_pre_save(sender, instance, **kwargs):
+    """Remember the stored resolution date so post_save can tell when an incident gets resolved"""
+    instance._old_date_resolution = None
+    if instance.pk:
+        instance._old_date_resolution = Incident.objects.filter(pk=instance.pk).values_list(
+            'date_resolution', flat=True
+        ).first()
 
 @receiver(post_save, sender=Incident)
 def incident_post_save(sender, instance, created, **kwargs):
     """Handle incident creation and auto-update expedition status if needed"""
     if created:
-        logger.warning(f"New incident created: {instance.type} for expedition {instance.expedition.numero if instance.expedition else 'N/A'}")
+        logger.warning("New incident created: %s for expedition %s", instance.type, instance.expedition.numero if instance.expedition else 'N/A')
         
         # Send notification
         NotificationService.notify_incident_created(instance)
@@ -82,75 +111,79 @@ def incident_post_save(sender, instance, created, **kwargs):
         if instance.expedition and instance.severite == 'critique':
             instance.expedition.statut = 'echec'
             instance.expedition.save()
-            logger.warning(f"Expedition {instance.expedition.numero} automatically marked as failed due to critical incident")
-    elif instance.date_resolution:
-        # Check if incident was just resolved
-        old_instance = Incident.objects.filter(pk=instance.pk).first()
-        if old_instance and not old_instance.date_resolution:
-            NotificationService.notify_incident_resolved(instance)
+            logger.warning("Expedition %s automatically marked as failed due to critical incident", instance.expedition.numero)
+    elif instance.date_resolution and not getattr(instance, '_old_date_resolution', None):
+        # Incident was just resolved
+        NotificationService.notify_incident_resolved(instance)
+
+def update_facture_payment_status(facture_id):
+    """Recompute an invoice's payment status from its payments in a single UPDATE"""
+    total_paid = Coalesce(
+        Subquery(
+            Paiement.objects.filter(facture=OuterRef('pk')).order_by().values('facture').annotate(
+                total=models.Sum('montant')
+            ).values('total')
+        ),
+        Value(Decimal('0')),
+        output_field=models.DecimalField()
+    )
+    return Facture.objects.filter(pk=facture_id).update(
+        est_payee=Case(
+            When(montant_ttc__lte=total_paid, then=Value('payee')),
+            When(GreaterThan(total_paid, 0), then=Value('partielle')),
+            default=Value('impayee')
+        ),
+        updated_at=timezone.now()
+    )
 
 @receiver(post_save, sender=Paiement)
 def paiement_post_save(sender, instance, created, **kwargs):
     """Update facture status when payment is made"""
     if created:
-        facture = instance.facture
-        total_paid = facture.paiements.aggregate(total=models.Sum('montant'))['total'] or 0
-
-        if total_paid >= facture.montant_ttc:
-            facture.est_payee = True
-            facture.save()
-            logger.info(f"Invoice {facture.id} fully paid")
+        update_facture_payment_status(instance.facture_id)
 
-        # Update client balance
-        client = facture.client
-        client.solde -= instance.montant
-        client.save()
+        # Update client balance atomically, without rewriting the whole client row
+        Client.objects.filter(facture__pk=instance.facture_id).update(solde=models.F('solde') - instance.montant)
 
-        logger.info(f"Payment of {instance.montant}€ recorded for invoice {facture.id}")
+        logger.info("Payment of %s€ recorded for invoice %s", instance.montant, instance.facture_id)
 
 @receiver(post_delete, sender=Paiement)
 def paiement_post_delete(sender, instance, **kwargs):
     """Handle payment deletion - reverse balance update"""
-    facture = instance.facture
-    client = facture.client
-    client.solde += instance.montant
-    client.save()
+    Client.objects.filter(facture__pk=instance.facture_id).update(solde=models.F('solde') + instance.montant)
 
-    # Check if invoice should be marked as unpaid
-    total_paid = facture.paiements.aggregate(total=models.Sum('montant'))['total'] or 0
-    if total_paid < facture.montant_ttc:
-        facture.est_payee = False
-        facture.save()
+    # The deleted payment no longer counts towards the invoice status
+    update_facture_payment_status(instance.facture_id)
 
-    logger.warning(f"Payment of {instance.montant}€ deleted for invoice {facture.id}")
+    logger.warning("Payment of %s€ deleted for invoice %s", instance.montant, instance.facture_id)
 
 @receiver(post_save, sender=Client)
 def client_post_save(sender, instance, created, **kwargs):
     """Log client changes"""
     if created:
-        logger.info(f"New client created: {instance.nom} {instance.prenom}")
+        logger.info("New client created: %s %s", instance.nom, instance.prenom)
     else:
-        logger.info(f"Client updated: {instance.nom} {instance.prenom}")
+        logger.info("Client updated: %s %s", instance.nom, instance.prenom)
 
 @receiver(post_save, sender=Chauffeur)
 def chauffeur_post_save(sender, instance, created, **kwargs):
     """Log chauffeur changes"""
     if created:
-        logger.info(f"New driver created: {instance.nom} {instance.prenom}")
+        logger.info("New driver created: %s %s", instance.nom, instance.prenom)
     else:
-        logger.info(f"Driver updated: {instance.nom} {instance.prenom}")
+        logger.info("Driver updated: %s %s", instance.nom, instance.prenom)
 
 @receiver(post_delete, sender=Expedition)
 def expedition_post_delete(sender, instance, **kwargs):
     """Log expedition deletion"""
-    logger.warning(f"Expedition deleted: {instance.numero}")
+    logger.warning("Expedition deleted: %s", instance.numero)
 
 @receiver(post_delete, sender=Facture)
 def facture_post_delete(sender, instance, **kwargs):
     """Handle facture deletion - reverse payments"""
-    # Reverse all payments for this invoice
-    for paiement in instance.paiements.all():
-        instance.client.solde += paiement.montant
-        instance.client.save()
+    # Reverse all payments for this invoice in one UPDATE
+    total = instance.paiements.aggregate(total=models.Sum('montant'))['total'] or 0
+    if total:
+        Client.objects.filter(pk=instance.client_id).update(solde=models.F('solde') + total)
 
-    logger.warning(f"Invoice {instance.id} deleted - payments reversed")
+    logger.warning("Invoice %s deleted - payments reversed", instance.id)
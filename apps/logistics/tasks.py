@@ -1,8 +1,46 @@
+import logging
+from asgiref.sync import async_to_sync
 from celery import shared_task
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import Count, Q, Sum
 from django.utils import timezone
 from datetime import timedelta
-from .models import Expedition, Tournee, TrackingLog
-from utils.calculators import PriceCalculator
+from .models import Expedition, ExpeditionStatusHistory, Notification, Tournee, TrackingLog
+from utils.calculators import (
+    calculate_fuel_consumption, calculate_shipping_cost, calculate_total_with_tva, calculate_tournee_cost
+)
+
+logger = logging.getLogger(__name__)
+
+# Expeditions completed per UPDATE / tracking log bulk_create
+STATUS_BATCH_SIZE = 1000
+
+# Expeditions priced per bulk_update
+COST_BATCH_SIZE = 500
+
+# Delivery notification emails sent per send_messages() call
+DELIVERY_NOTIFICATION_BATCH_SIZE = 2000
+
+# Delivery notification email, filled from Expedition.values() rows
+_DELIVERY_SUBJECT = 'Votre colis {numero} est prêt pour livraison'
+_DELIVERY_BODY = """
+            Bonjour {client__prenom} {client__nom},
+
+            Votre colis {numero} est arrivé à notre centre de distribution
+            et est prêt pour livraison.
+
+            Détails de l'expédition:
+            - Numéro: {numero}
+            - Destination: {destination__ville}, {destination__pays}
+            - Poids: {poids} kg
+            - Volume: {volume} m³
+
+            Nous vous contacterons bientôt pour organiser la livraison.
+
+            Cordialement,
+            L'équipe Transport Manager
+            """
 
 
 @shared_task
@@ -13,37 +51,62 @@ def update_shipment_statuses():
     now = timezone.now()
 
     # Update expeditions that should be in transit
-    Expedition.objects.filter(
+    _transition_statuses(Expedition.objects.filter(
         date_creation__lte=now - timedelta(hours=1),
         statut='tri'
-    ).update(statut='en_transit')
+    ), 'en_transit', now)
 
     # Update expeditions that should be in delivery
-    Expedition.objects.filter(
+    _transition_statuses(Expedition.objects.filter(
         date_creation__lte=now - timedelta(hours=24),
         statut='en_transit'
-    ).update(statut='livraison')
+    ), 'livraison', now)
 
     # Auto-complete old expeditions (for demo purposes - in production this would be manual)
     old_expeditions = Expedition.objects.filter(
         date_creation__lte=now - timedelta(days=7),
         statut__in=['livraison', 'en_transit']
     )
+    ids = _transition_statuses(old_expeditions, 'livre', now, date_livraison=now)
 
-    for expedition in old_expeditions:
-        expedition.statut = 'livre'
-        expedition.date_livraison = now
-        expedition.save()
-
-        # Create final tracking log
-        TrackingLog.objects.create(
-            expedition=expedition,
+    # Create final tracking logs
+    TrackingLog.objects.bulk_create([
+        TrackingLog(
+            expedition_id=expedition_id,
             statut='livre',
             lieu='Destination',
             commentaire='Livraison automatique (système)'
         )
+        for expedition_id in ids
+    ], batch_size=STATUS_BATCH_SIZE)
 
-    return f"Updated {old_expeditions.count()} expeditions"
+    return f"Updated {len(ids)} expeditions"
+
+
+def _transition_statuses(expeditions, new_status, now, **fields):
+    """
+    Move expeditions to new_status with one UPDATE per batch and record their status history
+
+    Queryset updates skip expedition_pre_save, so the history rows are bulk-inserted here instead
+    and admins get one summary notification.
+    Returns the ids of the updated expeditions.
+    """
+    from .notification_service import NotificationService
+
+    rows = list(expeditions.values_list('id', 'statut'))
+    for start in range(0, len(rows), STATUS_BATCH_SIZE):
+        batch = rows[start:start + STATUS_BATCH_SIZE]
+        Expedition.objects.filter(id__in=[expedition_id for expedition_id, _ in batch]).update(
+            statut=new_status, updated_at=now, **fields
+        )
+        ExpeditionStatusHistory.objects.bulk_create([
+            ExpeditionStatusHistory(expedition_id=expedition_id, old_status=old_status, new_status=new_status)
+            for expedition_id, old_status in batch
+        ])
+
+    ids = [expedition_id for expedition_id, _ in rows]
+    NotificationService.notify_bulk_status_change(ids, new_status)
+    return ids
 
 
 @shared_task
@@ -51,57 +114,83 @@ def calculate_expedition_costs():
     """
     Background task to calculate and update expedition costs
     """
-    expeditions_without_cost = Expedition.objects.filter(montant=0)
+    expeditions_without_cost = Expedition.objects.filter(montant=0).select_related('destination', 'type_service')
 
     updated_count = 0
-    for expedition in expeditions_without_cost:
+    now = timezone.now()
+    batch = []
+    for expedition in expeditions_without_cost.iterator(chunk_size=COST_BATCH_SIZE):
         try:
-            pricing = PriceCalculator.calculate_expedition_price(expedition)
-            expedition.montant = pricing['total_ttc']
-            expedition.save()
-            updated_count += 1
-        except Exception as e:
+            amount_ht = calculate_shipping_cost(
+                expedition.type_service, expedition.destination, expedition.poids, expedition.volume
+            )
+            expedition.montant = calculate_total_with_tva(amount_ht)[1]
+            expedition.updated_at = now
+        except Exception:
             # Log error but continue processing
-            print(f"Error calculating cost for expedition {expedition.numero}: {e}")
+            logger.exception("Error calculating cost for expedition %s", expedition.numero)
             continue
 
+        batch.append(expedition)
+        if len(batch) == COST_BATCH_SIZE:
+            updated_count += _save_expedition_costs(batch)
+            batch = []
+    if batch:
+        updated_count += _save_expedition_costs(batch)
+
     return f"Calculated costs for {updated_count} expeditions"
 
 
+def _save_expedition_costs(batch):
+    """Write one batch of priced expeditions in its own transaction; a failed batch is logged and skipped"""
+    try:
+        with transaction.atomic():
+            return Expedition.objects.bulk_update(batch, ['montant', 'updated_at'])
+    except Exception:
+        logger.exception("Failed to save costs for %d expeditions", len(batch))
+        return 0
+
+
 @shared_task
 def generate_tournee_report(tournee_id):
     """
     Generate a detailed report for a specific tournee
     """
     try:
-        tournee = Tournee.objects.get(id=tournee_id)
-        expeditions = tournee.expeditions.all()
+        tournee = Tournee.objects.values(
+            'id', 'date', 'kilometrage', 'chauffeur__nom', 'chauffeur__prenom',
+            'vehicule__immatriculation', 'vehicule__consommation'
+        ).get(id=tournee_id)
+        totals = Expedition.objects.filter(tournee_id=tournee_id).aggregate(
+            total_expeditions=Count('id'),
+            total_weight=Sum('poids'),
+            total_volume=Sum('volume'),
+            total_revenue=Sum('montant'),
+            en_transit=Count('id', filter=Q(statut='en_transit')),
+            livraison=Count('id', filter=Q(statut='livraison')),
+            livre=Count('id', filter=Q(statut='livre')),
+            echec=Count('id', filter=Q(statut='echec'))
+        )
 
         report_data = {
-            'tournee_id': tournee.id,
-            'date': tournee.date.isoformat(),
-            'chauffeur': f"{tournee.chauffeur.nom} {tournee.chauffeur.prenom}",
-            'vehicule': tournee.vehicule.immatriculation,
-            'total_expeditions': expeditions.count(),
-            'total_weight': sum(exp.poids for exp in expeditions),
-            'total_volume': sum(exp.volume for exp in expeditions),
-            'total_revenue': sum(exp.montant for exp in expeditions),
+            'tournee_id': tournee['id'],
+            'date': tournee['date'].isoformat(),
+            'chauffeur': f"{tournee['chauffeur__nom']} {tournee['chauffeur__prenom']}",
+            'vehicule': tournee['vehicule__immatriculation'],
+            'total_expeditions': totals['total_expeditions'],
+            'total_weight': totals['total_weight'] or 0,
+            'total_volume': totals['total_volume'] or 0,
+            'total_revenue': totals['total_revenue'] or 0,
             'status_breakdown': {
-                'en_transit': expeditions.filter(statut='en_transit').count(),
-                'livraison': expeditions.filter(statut='livraison').count(),
-                'livre': expeditions.filter(statut='livre').count(),
-                'echec': expeditions.filter(statut='echec').count(),
+                statut: totals[statut] for statut in ('en_transit', 'livraison', 'livre', 'echec')
             }
         }
 
-        # Calculate costs if available
-        try:
-            cost_data = PriceCalculator.calculate_tournee_cost(tournee)
-            report_data['costs'] = cost_data
-            report_data['profit'] = report_data['total_revenue'] - cost_data['total_cost']
-        except:
-            report_data['costs'] = None
-            report_data['profit'] = None
+        # Operating costs from the tour distance and the vehicle's fuel consumption
+        fuel_liters = calculate_fuel_consumption(tournee['kilometrage'], tournee['vehicule__consommation'])
+        cost_data = calculate_tournee_cost(tournee['kilometrage'], fuel_liters)
+        report_data['costs'] = cost_data
+        report_data['profit'] = report_data['total_revenue'] - cost_data['total_cost']
 
         return report_data
 
@@ -114,50 +203,47 @@ def send_delivery_notifications():
     """
     Send notifications for expeditions that are ready for delivery
     """
-    from django.core.mail import send_mail
+    from django.core.mail import EmailMessage, get_connection
     from django.conf import settings
 
     expeditions_ready = Expedition.objects.filter(
         statut='livraison',
         client__email__isnull=False
-    ).exclude(client__email='')
+    ).exclude(client__email='').values(
+        'numero', 'poids', 'volume', 'client__email', 'client__nom', 'client__prenom',
+        'destination__ville', 'destination__pays'
+    )
 
     sent_count = 0
-    for expedition in expeditions_ready:
-        try:
-            subject = f'Votre colis {expedition.numero} est prêt pour livraison'
-            message = f"""
-            Bonjour {expedition.client.prenom} {expedition.client.nom},
-
-            Votre colis {expedition.numero} est arrivé à notre centre de distribution
-            et est prêt pour livraison.
-
-            Détails de l'expédition:
-            - Numéro: {expedition.numero}
-            - Destination: {expedition.destination.ville}, {expedition.destination.pays}
-            - Poids: {expedition.poids} kg
-            - Volume: {expedition.volume} m³
-
-            Nous vous contacterons bientôt pour organiser la livraison.
-
-            Cordialement,
-            L'équipe Transport Manager
-            """
+    try:
+        # One SMTP connection for the whole run instead of one per expedition
+        with get_connection() as connection:
+            batch = []
+            for row in expeditions_ready.iterator(chunk_size=DELIVERY_NOTIFICATION_BATCH_SIZE):
+                batch.append(EmailMessage(
+                    _DELIVERY_SUBJECT.format_map(row),
+                    _DELIVERY_BODY.format_map(row),
+                    settings.DEFAULT_FROM_EMAIL,
+                    [row['client__email']]
+                ))
+                if len(batch) == DELIVERY_NOTIFICATION_BATCH_SIZE:
+                    sent_count += _send_delivery_batch(connection, batch)
+                    batch = []
+            if batch:
+                sent_count += _send_delivery_batch(connection, batch)
+    except Exception:
+        logger.exception("Error sending delivery notifications")
 
-            send_mail(
-                subject,
-                message,
-                settings.DEFAULT_FROM_EMAIL,
-                [expedition.client.email],
-                fail_silently=False,
-            )
-            sent_count += 1
+    return f"Sent {sent_count} delivery notifications"
 
-        except Exception as e:
-            print(f"Error sending notification for expedition {expedition.numero}: {e}")
-            continue
 
-    return f"Sent {sent_count} delivery notifications"
+def _send_delivery_batch(connection, batch):
+    """Send one batch of delivery emails; a failed batch is logged and skipped"""
+    try:
+        return connection.send_messages(batch) or 0
+    except Exception:
+        logger.exception("Failed to send %d delivery notifications", len(batch))
+        return 0
 
 
 @shared_task
@@ -171,10 +257,79 @@ def archive_old_expeditions():
         statut='livre'
     )
 
-    archived_count = 0
-    for expedition in old_expeditions:
-        expedition.is_active = False
-        expedition.save()
-        archived_count += 1
+    archived_count = old_expeditions.update(is_active=False, updated_at=timezone.now())
 
     return f"Archived {archived_count} old expeditions"
+
+
+@shared_task
+def refresh_status_view():
+    """
+    Refresh the expedition_time_in_status materialized view used by the time-in-status analytics
+    """
+    from django.db import connection
+
+    if connection.vendor != 'postgresql':
+        return "Time-in-status view is only available on PostgreSQL"
+
+    with connection.cursor() as cursor:
+        cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY expedition_time_in_status;")
+
+    return "Time-in-status view refreshed"
+
+
+@shared_task
+def predict_delivery_time(expedition_id):
+    """
+    Compute the predicted delivery time of a new expedition and push it to tracking clients
+    """
+    from .prediction_service import prediction_service
+
+    try:
+        expedition = Expedition.objects.select_related('type_service', 'destination').get(id=expedition_id)
+    except Expedition.DoesNotExist:
+        return None
+
+    predicted_time = prediction_service.predict_delivery_time(expedition)
+    if not predicted_time:
+        return None
+    Expedition.objects.filter(id=expedition_id).update(predicted_delivery_time=predicted_time)
+
+    try:
+        async_to_sync(get_channel_layer().group_send)(f'expedition_{expedition_id}', {
+            'type': 'expedition_update',
+            'data': {'predicted_delivery_time': predicted_time.isoformat()}
+        })
+    except Exception as e:
+        logger.warning(f"Failed to broadcast prediction for expedition {expedition_id}: {e}")
+
+    return predicted_time.isoformat()
+
+
+@shared_task
+def dispatch_notification(notification_id):
+    """
+    Send the email and SMS of a single notification
+    """
+    from .notification_service import NotificationService
+
+    notification = Notification.objects.select_related('user', 'client').filter(id=notification_id).first()
+    if not notification:
+        return None
+
+    email_sent = NotificationService.send_email_notification(notification)
+    sms_sent = NotificationService.send_sms_notification(notification)
+    return {'email': email_sent, 'sms': sms_sent}
+
+
+@shared_task
+def dispatch_notification_batch(notification_ids):
+    """
+    Send the email and SMS of a batch of notifications, the emails over one SMTP connection
+    """
+    from .notification_service import NotificationService
+
+    notifications = list(Notification.objects.select_related('user', 'client').filter(id__in=notification_ids))
+    emails_sent = NotificationService.send_bulk_email(notifications)
+    sms_sent = sum(NotificationService.send_sms_notification(notification) for notification in notifications)
+    return f"Sent {emails_sent} notification emails and {sms_sent} SMS"
@@ -4,34 +4,36 @@ from django.utils import timezone
 from decimal import Decimal
 from datetime import timedelta
 from apps.core.models import Client, Chauffeur, Vehicule, Destination, TypeService
+from .cluster import cluster_points
 from .models import Expedition, Tournee, TrackingLog
 from .serializers import ExpeditionSerializer, TourneeSerializer
 
 
 class ExpeditionModelTest(TestCase):
-    def setUp(self):
-        self.client = Client.objects.create(
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_obj = Client.objects.create(
             nom="Test", prenom="Client", email="client@test.com",
             telephone="+33123456789", adresse="Test Address"
         )
-        self.destination = Destination.objects.create(
+        cls.destination = Destination.objects.create(
             ville="Paris", pays="France", zone_geographique="Europe", tarif_base=50.00
         )
-        self.type_service = TypeService.objects.create(nom="Standard")
-        self.chauffeur = Chauffeur.objects.create(
+        cls.type_service = TypeService.objects.create(nom="Standard")
+        cls.chauffeur = Chauffeur.objects.create(
             nom="Test", prenom="Driver", numero_permis="TEST123",
             telephone="+33123456789", date_embauche=timezone.now().date()
         )
-        self.vehicule = Vehicule.objects.create(
+        cls.vehicule = Vehicule.objects.create(
             immatriculation="TEST-123", type="Camion", capacite=3000,
             consommation=8.0, etat="disponible"
         )
 
-        self.expedition = Expedition.objects.create(
+        cls.expedition = Expedition.objects.create(
             numero="EXP000001",
-            client=self.client,
-            type_service=self.type_service,
-            destination=self.destination,
+            client=cls.client_obj,
+            type_service=cls.type_service,
+            destination=cls.destination,
             poids=100.0,
             volume=2.0,
             description="Test expedition",
@@ -41,7 +43,7 @@ class ExpeditionModelTest(TestCase):
     def test_expedition_creation(self):
         """Test expedition model creation"""
         self.assertEqual(self.expedition.numero, "EXP000001")
-        self.assertEqual(self.expedition.client, self.client)
+        self.assertEqual(self.expedition.client, self.client_obj)
         self.assertEqual(self.expedition.statut, "en_transit")
         self.assertEqual(self.expedition.montant, Decimal('150.00'))
 
@@ -50,7 +52,7 @@ class ExpeditionModelTest(TestCase):
         with self.assertRaises(Exception):
             Expedition.objects.create(
                 numero="EXP000001",  # Same number
-                client=self.client,
+                client=self.client_obj,
                 type_service=self.type_service,
                 destination=self.destination,
                 poids=50.0,
@@ -69,20 +71,21 @@ class ExpeditionModelTest(TestCase):
 
 
 class TourneeModelTest(TestCase):
-    def setUp(self):
-        self.chauffeur = Chauffeur.objects.create(
+    @classmethod
+    def setUpTestData(cls):
+        cls.chauffeur = Chauffeur.objects.create(
             nom="Tournee", prenom="Driver", numero_permis="TOUR123",
             telephone="+33123456789", date_embauche=timezone.now().date()
         )
-        self.vehicule = Vehicule.objects.create(
+        cls.vehicule = Vehicule.objects.create(
             immatriculation="TOUR-123", type="Camion", capacite=3000,
             consommation=8.0, etat="disponible"
         )
 
-        self.tournee = Tournee.objects.create(
+        cls.tournee = Tournee.objects.create(
             date=timezone.now().date(),
-            chauffeur=self.chauffeur,
-            vehicule=self.vehicule,
+            chauffeur=cls.chauffeur,
+            vehicule=cls.vehicule,
             kilometrage=150.0,
             duree=timedelta(hours=8),
             consommation=45.0
@@ -97,37 +100,38 @@ class TourneeModelTest(TestCase):
 
 
 class TrackingLogModelTest(TestCase):
-    def setUp(self):
+    @classmethod
+    def setUpTestData(cls):
         # Create required related objects
-        self.client = Client.objects.create(
+        cls.client_obj = Client.objects.create(
             nom="Track", prenom="Client", email="track@test.com",
             telephone="+33123456789", adresse="Track Address"
         )
-        self.destination = Destination.objects.create(
+        cls.destination = Destination.objects.create(
             ville="Lyon", pays="France", zone_geographique="Europe", tarif_base=40.00
         )
-        self.type_service = TypeService.objects.create(nom="Express")
-        self.chauffeur = Chauffeur.objects.create(
+        cls.type_service = TypeService.objects.create(nom="Express")
+        cls.chauffeur = Chauffeur.objects.create(
             nom="Track", prenom="Driver", numero_permis="TRACK123",
             telephone="+33123456789", date_embauche=timezone.now().date()
         )
 
-        self.expedition = Expedition.objects.create(
+        cls.expedition = Expedition.objects.create(
             numero="EXP000002",
-            client=self.client,
-            type_service=self.type_service,
-            destination=self.destination,
+            client=cls.client_obj,
+            type_service=cls.type_service,
+            destination=cls.destination,
             poids=75.0,
             volume=1.5,
             montant=120.00
         )
 
-        self.tracking_log = TrackingLog.objects.create(
-            expedition=self.expedition,
+        cls.tracking_log = TrackingLog.objects.create(
+            expedition=cls.expedition,
             lieu="Paris Distribution Center",
             statut="en_transit",
             commentaire="Package received and processed",
-            chauffeur=self.chauffeur
+            chauffeur=cls.chauffeur
         )
 
     def test_tracking_log_creation(self):
@@ -143,29 +147,43 @@ class TrackingLogModelTest(TestCase):
         self.assertEqual(str(self.tracking_log), expected)
 
 
+class ClusterTest(TestCase):
+    def test_cluster_points(self):
+        paris = [(48.8566 + i * 0.0001, 2.3522) for i in range(5)]
+        marseille = [(43.2965, 5.3698)]
+
+        clusters = cluster_points(paris + marseille, zoom=6)
+        self.assertEqual(sorted(c['count'] for c in clusters), [1, 5])
+        self.assertEqual(len(cluster_points(paris + marseille, zoom=0)), 1)
+        self.assertEqual(len(cluster_points(paris + marseille, zoom=18)), 6)
+        self.assertEqual(cluster_points([], zoom=6), [])
+
+
 class ExpeditionSerializerTest(TestCase):
-    def setUp(self):
+    @classmethod
+    def setUpTestData(cls):
         # Create test data
-        self.client = Client.objects.create(
+        cls.client_obj = Client.objects.create(
             nom="Serializer", prenom="Test", email="serializer@test.com",
             telephone="+33123456789", adresse="Serializer Address"
         )
-        self.destination = Destination.objects.create(
+        cls.destination = Destination.objects.create(
             ville="Marseille", pays="France", zone_geographique="Europe", tarif_base=60.00
         )
-        self.type_service = TypeService.objects.create(nom="Premium")
+        cls.type_service = TypeService.objects.create(nom="Premium")
 
-        self.expedition = Expedition.objects.create(
+        cls.expedition = Expedition.objects.create(
             numero="EXP000003",
-            client=self.client,
-            type_service=self.type_service,
-            destination=self.destination,
+            client=cls.client_obj,
+            type_service=cls.type_service,
+            destination=cls.destination,
             poids=200.0,
             volume=4.0,
             description="Serializer test expedition",
             montant=300.00
         )
 
+    def setUp(self):
         self.serializer = ExpeditionSerializer(instance=self.expedition)
 
     def test_expedition_serializer_fields(self):
@@ -182,7 +200,7 @@ class ExpeditionSerializerTest(TestCase):
         """Test expedition serializer validation"""
         data = {
             'numero': 'EXP000004',
-            'client': self.client.id,
+            'client': self.client_obj.id,
             'type_service': self.type_service.id,
             'destination': self.destination.id,
             'poids': -10,  # Invalid negative weight
@@ -196,26 +214,27 @@ class ExpeditionSerializerTest(TestCase):
 
 class APITestCase(TestCase):
     """Base test case for API tests"""
-    def setUp(self):
+    @classmethod
+    def setUpTestData(cls):
         from django.contrib.auth import get_user_model
         User = get_user_model()
 
         # Create test user
-        self.user = User.objects.create_user(
+        cls.user = User.objects.create_user(
             username='testuser',
             email='test@example.com',
             password='testpass123'
         )
 
         # Create test data
-        self.client_obj = Client.objects.create(
+        cls.client_obj = Client.objects.create(
             nom="API", prenom="Test", email="api@test.com",
             telephone="+33123456789", adresse="API Test Address"
         )
-        self.destination = Destination.objects.create(
+        cls.destination = Destination.objects.create(
             ville="Toulouse", pays="France", zone_geographique="Europe", tarif_base=45.00
         )
-        self.type_service = TypeService.objects.create(nom="Eco")
+        cls.type_service = TypeService.objects.create(nom="Eco")
 
     def test_expedition_api_creation(self):
         """Test expedition creation via API"""
@@ -234,6 +253,431 @@ class APITestCase(TestCase):
             'montant': 85.00
         }
 
-        response = client.post('/logistics/api/expeditions/', data, format='json')
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = client.post('/logistics/api/expeditions/', data, format='json')
         self.assertEqual(response.status_code, 201)
         self.assertEqual(response.data['numero'], 'EXP000005')
+        self.assertEqual(len(callbacks), 2)  # statistics invalidation + prediction task
+
+        expedition = Expedition.objects.get(numero='EXP000005')
+        self.assertEqual(expedition.montant, Decimal('85.00'))
+        self.assertIsNone(expedition.predicted_delivery_time)
+
+    def test_predict_delivery_time_task(self):
+        """Test the prediction task stores the predicted delivery time"""
+        from .tasks import predict_delivery_time
+
+        expedition = Expedition.objects.create(
+            numero='EXP000006', client=self.client_obj, type_service=self.type_service,
+            destination=self.destination, poids=50.0, volume=1.0, montant=85.00
+        )
+        predict_delivery_time(expedition.id)
+
+        expedition.refresh_from_db()
+        self.assertEqual(expedition.predicted_delivery_time, expedition.date_creation + timedelta(hours=30))
+
+    def test_update_predictions_batch(self):
+        """Test batched predictions match the single-expedition path"""
+        import numpy as np
+        from sklearn.ensemble import RandomForestRegressor
+        from .prediction_service import PredictionService
+
+        rng = np.random.default_rng(0)
+        X = rng.random((50, 5)) * 100
+        service = PredictionService()
+        service.model = RandomForestRegressor(n_estimators=5, random_state=0).fit(service.scaler.fit_transform(X), X.sum(axis=1))
+        service.is_trained = True
+
+        for i in range(3):
+            Expedition.objects.create(
+                numero=f'EXP00002{i}', client=self.client_obj, type_service=self.type_service,
+                destination=self.destination, poids=10 + i * 20, volume=1.5 + i, montant=85.00
+            )
+
+        self.assertEqual(service.update_predictions(batch_size=2), 3)
+        for expedition in Expedition.objects.select_related('type_service', 'destination'):
+            self.assertEqual(expedition.predicted_delivery_time, service.predict_delivery_time(expedition))
+
+    def test_predict_delivery_time_with_float32_model(self):
+        """Test a float32 ONNX Runtime prediction is used by the single-expedition path"""
+        import numpy as np
+        from sklearn.ensemble import RandomForestRegressor
+        from .prediction_service import PredictionService
+
+        class StubSession:
+            """Returns what an ONNX Runtime regressor session returns: a float32 (n, 1) array"""
+            def run(self, output_names, inputs):
+                return [np.full((len(inputs['X']), 1), 12.5, dtype=np.float32)]
+
+        rng = np.random.default_rng(0)
+        X = rng.random((50, 5)) * 100
+        service = PredictionService()
+        service.model = RandomForestRegressor(n_estimators=5, random_state=0).fit(service.scaler.fit_transform(X), X.sum(axis=1))
+        service._ort_session = StubSession()
+        service.is_trained = True
+
+        expedition = Expedition.objects.create(
+            numero='EXP000030', client=self.client_obj, type_service=self.type_service,
+            destination=self.destination, poids=50.0, volume=1.0, montant=85.00
+        )
+        expected = expedition.date_creation + timedelta(hours=12.5)
+        self.assertEqual(service.predict_delivery_time(expedition), expected)
+        self.assertEqual(service.predict_delivery_time_batch([expedition]), [expected])
+
+
+class TourneeAPITest(TestCase):
+    """API tests for tour expedition assignment"""
+    @classmethod
+    def setUpTestData(cls):
+        from django.contrib.auth import get_user_model
+        User = get_user_model()
+
+        cls.user = User.objects.create_user(
+            username='admin', email='admin@test.com', password='testpass123', role='admin'
+        )
+
+        client = Client.objects.create(
+            nom="Tour", prenom="Client", email="tour@test.com",
+            telephone="+33123456789", adresse="Tour Address"
+        )
+        destination = Destination.objects.create(
+            ville="Lyon", pays="France", zone_geographique="Europe", tarif_base=50.00
+        )
+        type_service = TypeService.objects.create(nom="Standard")
+        chauffeur = Chauffeur.objects.create(
+            nom="Tour", prenom="Driver", numero_permis="TOURAPI1",
+            telephone="+33123456789", date_embauche=timezone.now().date()
+        )
+        vehicule = Vehicule.objects.create(
+            immatriculation="TOUR-API", type="Camion", capacite=3000,
+            consommation=8.0, etat="disponible"
+        )
+        cls.tournee = Tournee.objects.create(
+            date=timezone.now().date(), chauffeur=chauffeur, vehicule=vehicule,
+            kilometrage=0, duree=timedelta(hours=8), consommation=0
+        )
+        cls.expeditions = [
+            Expedition.objects.create(
+                numero=f"EXP00010{i}", client=client, type_service=type_service,
+                destination=destination, poids=10.0, volume=1.0, montant=50.00
+            )
+            for i in range(2)
+        ]
+        cls.url = f'/logistics/api/tournees/{cls.tournee.id}/'
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.user)
+
+    def test_add_and_remove_expedition_updates_totals(self):
+        """Test tour totals follow expedition assignment"""
+        for expedition in self.expeditions:
+            response = self.api_client.post(self.url + 'add_expedition/', {'expedition_id': expedition.id}, format='json')
+            self.assertEqual(response.status_code, 200)
+
+        self.tournee.refresh_from_db()
+        self.assertEqual(self.tournee.kilometrage, 100)
+        self.assertEqual(self.tournee.consommation, 8)
+        self.assertEqual(self.tournee.total_weight, Decimal('20.00'))
+
+        response = self.api_client.post(self.url + 'remove_expedition/', {'expedition_id': self.expeditions[0].id}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        self.tournee.refresh_from_db()
+        self.assertEqual(self.tournee.kilometrage, 50)
+        self.assertEqual(self.tournee.consommation, 4)
+        self.assertEqual(self.tournee.total_weight, Decimal('10.00'))
+        self.assertEqual(self.tournee.total_volume, Decimal('1.00'))
+
+    def test_update_and_delete_expedition_updates_totals(self):
+        """Test tour totals follow expedition edits and deletion"""
+        expedition = self.expeditions[0]
+        self.api_client.post(self.url + 'add_expedition/', {'expedition_id': expedition.id}, format='json')
+
+        data = {
+            'numero': expedition.numero, 'client': expedition.client_id, 'type_service': expedition.type_service_id,
+            'destination': expedition.destination_id, 'poids': '25.00', 'volume': '1.00', 'montant': '50.00',
+            'tournee': self.tournee.id
+        }
+        response = self.api_client.put(f'/logistics/api/expeditions/{expedition.id}/', data, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        self.tournee.refresh_from_db()
+        self.assertEqual(self.tournee.kilometrage, 50)
+        self.assertEqual(self.tournee.total_weight, Decimal('25.00'))
+
+        response = self.api_client.delete(f'/logistics/api/expeditions/{expedition.id}/')
+        self.assertEqual(response.status_code, 204)
+
+        self.tournee.refresh_from_db()
+        self.assertEqual(self.tournee.kilometrage, 0)
+        self.assertEqual(self.tournee.total_weight, Decimal('0.00'))
+
+    def test_add_expedition_already_assigned(self):
+        """Test an expedition cannot be added to two tours"""
+        expedition = self.expeditions[0]
+        expedition.tournee = self.tournee
+        expedition.save()
+
+        response = self.api_client.post(self.url + 'add_expedition/', {'expedition_id': expedition.id}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_and_expeditions_list(self):
+        """Test tour listing counts expeditions without loading them"""
+        for expedition in self.expeditions:
+            expedition.tournee = self.tournee
+            expedition.save()
+
+        response = self.api_client.get('/logistics/api/tournees/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['expedition_count'], 2)
+
+        response = self.api_client.get(self.url + 'expeditions_list/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({e['numero'] for e in response.data}, {'EXP000100', 'EXP000101'})
+
+    def test_expedition_list_queries(self):
+        """Test expedition list loads related labels without extra queries"""
+        for expedition in self.expeditions:
+            expedition.tournee = self.tournee
+            expedition.save()
+
+        with self.assertNumQueries(2):  # COUNT for pagination + page SELECT
+            response = self.api_client.get('/logistics/api/expeditions/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['client_nom'], 'Tour')
+        self.assertEqual(response.data['results'][0]['tournee_date'], str(self.tournee.date))
+
+    def test_bulk_update_status(self):
+        """Test bulk status update records one history row per changed expedition"""
+        from .models import ExpeditionStatusHistory, Notification
+
+        changes = [{'id': expedition.id, 'statut': 'tri'} for expedition in self.expeditions]
+        response = self.api_client.post('/logistics/api/expeditions/bulk_update_status/', {'changes': changes}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['updated'], 2)
+        self.assertEqual(Expedition.objects.filter(statut='tri').count(), 2)
+        self.assertEqual(ExpeditionStatusHistory.objects.filter(old_status='en_transit', new_status='tri').count(), 2)
+        self.assertEqual(Notification.objects.filter(user=self.user, category='expedition').count(), 1)  # One admin summary
+
+        response = self.api_client.post('/logistics/api/expeditions/bulk_update_status/', {'changes': changes}, format='json')
+        self.assertEqual(response.data['updated'], 0)
+
+        response = self.api_client.post('/logistics/api/expeditions/bulk_update_status/', {'changes': [{'id': 1, 'statut': 'perdu'}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.api_client.post('/logistics/api/expeditions/bulk_update_status/', {'changes': [{'id': 'abc', 'statut': 'tri'}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        # Delivering requires the change_expedition_status permission
+        changes = [{'id': self.expeditions[0].id, 'statut': 'livre'}]
+        response = self.api_client.post('/logistics/api/expeditions/bulk_update_status/', {'changes': changes}, format='json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_time_in_status(self):
+        """Test average time in status is computed between consecutive transitions"""
+        from .models import ExpeditionStatusHistory
+
+        start = timezone.now() - timedelta(days=1)
+        for expedition, transit_hours in zip(self.expeditions, (2, 4)):
+            for status_, offset in (('en_transit', 0), ('livre', transit_hours)):
+                history = ExpeditionStatusHistory.objects.create(
+                    expedition=expedition, old_status='creee', new_status=status_
+                )
+                ExpeditionStatusHistory.objects.filter(pk=history.pk).update(timestamp=start + timedelta(hours=offset))
+
+        response = self.api_client.get('/logistics/api/expeditions/time_in_status/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [{'statut': 'en_transit', 'average_hours': 3.0, 'transitions': 2}])
+
+    def test_assign_to_tour(self):
+        """Test assigning an expedition to a tour from the expedition endpoint"""
+        url = f'/logistics/api/expeditions/{self.expeditions[0].id}/assign_to_tour/'
+
+        response = self.api_client.post(url, {'tournee_id': self.tournee.id}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.expeditions[0].refresh_from_db()
+        self.assertEqual(self.expeditions[0].tournee, self.tournee)
+
+        response = self.api_client.post(url, {'tournee_id': self.tournee.id}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.api_client.post(url, {'tournee_id': 9999}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+
+class MapAPITest(TestCase):
+    """API tests for the expedition and tour map endpoints"""
+    @classmethod
+    def setUpTestData(cls):
+        from django.contrib.auth import get_user_model
+        User = get_user_model()
+
+        cls.user = User.objects.create_user(
+            username='mapper', email='mapper@test.com', password='testpass123', role='admin'
+        )
+
+        client = Client.objects.create(
+            nom="Map", prenom="Client", email="map@test.com",
+            telephone="+33123456789", adresse="Map Address"
+        )
+        type_service = TypeService.objects.create(nom="Standard")
+        paris = Destination.objects.create(
+            nom="Paris Centre", ville="Paris", pays="France", zone_geographique="Europe",
+            tarif_base=30.00, latitude=48.8566, longitude=2.3522
+        )
+        lyon = Destination.objects.create(
+            nom="Lyon Part-Dieu", ville="Lyon", pays="France", zone_geographique="Europe",
+            tarif_base=40.00, latitude=45.7640, longitude=4.8357
+        )
+        unlocated = Destination.objects.create(
+            ville="Nice", pays="France", zone_geographique="Europe", tarif_base=50.00
+        )
+        chauffeur = Chauffeur.objects.create(
+            nom="Map", prenom="Driver", numero_permis="MAPAPI1",
+            telephone="+33123456789", date_embauche=timezone.now().date()
+        )
+        vehicule = Vehicule.objects.create(
+            immatriculation="MAP-API", type="Camion", capacite=3000,
+            consommation=8.0, etat="disponible"
+        )
+        cls.tournee = Tournee.objects.create(
+            date=timezone.now().date(), chauffeur=chauffeur, vehicule=vehicule,
+            kilometrage=0, duree=timedelta(hours=8), consommation=0
+        )
+        cls.expeditions = [
+            Expedition.objects.create(
+                numero=f"EXP00020{i}", client=client, type_service=type_service,
+                destination=destination, poids=10.0, volume=1.0, montant=50.00,
+                statut=statut, tournee=cls.tournee
+            )
+            for i, (destination, statut) in enumerate(((paris, 'en_transit'), (lyon, 'livre'), (unlocated, 'tri')))
+        ]
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.user)
+
+    def test_expedition_map(self):
+        """Test only located expeditions are mapped, limited to the ?bbox viewport"""
+        response = self.api_client.get('/logistics/api/map/expeditions/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total_count'], 2)
+
+        response = self.api_client.get('/logistics/api/map/expeditions/', {'bbox': '2,48,3,49'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([exp['numero'] for exp in response.data['expeditions']], ['EXP000200'])
+        self.assertEqual(response.data['expeditions'][0]['destination'], 'Paris Centre')
+        self.assertEqual((response.data['expeditions'][0]['lat'], response.data['expeditions'][0]['lng']), (48.8566, 2.3522))
+
+        response = self.api_client.get('/logistics/api/map/expeditions/', {'bbox': '2,48,3'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_expedition_map_msgpack(self):
+        """Test the expedition map can be fetched as MessagePack"""
+        import msgpack
+
+        response = self.api_client.get('/logistics/api/map/expeditions/', HTTP_ACCEPT='application/x-msgpack')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(msgpack.unpackb(response.content)['total_count'], 2)
+
+    def test_expedition_clusters(self):
+        """Test markers are clustered per zoom level"""
+        response = self.api_client.get('/logistics/api/map/clusters/', {'zoom': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total_count'], 2)
+        self.assertEqual([cluster['count'] for cluster in response.data['clusters']], [2])
+
+        response = self.api_client.get('/logistics/api/map/clusters/', {'zoom': 10})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(cluster['count'] for cluster in response.data['clusters']), [1, 1])
+
+        for zoom in ('abc', 19):
+            response = self.api_client.get('/logistics/api/map/clusters/', {'zoom': zoom})
+            self.assertEqual(response.status_code, 400)
+
+    def test_tournee_map(self):
+        """Test the tour map starts at the depot and skips unlocated stops"""
+        response = self.api_client.get(f'/logistics/api/map/tournees/{self.tournee.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['expedition_markers']), 2)
+        self.assertEqual(len(response.data['route_points']), 3)
+        self.assertEqual(response.data['route_points'][0], [response.data['depot']['lat'], response.data['depot']['lng']])
+        self.assertEqual(response.data['tournee']['vehicule'], 'MAP-API')
+
+        response = self.api_client.get('/logistics/api/map/tournees/9999/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_heat_map(self):
+        """Test the heat map only packs delivered expeditions"""
+        response = self.api_client.get('/logistics/api/map/heatmap/')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['count'], 1)
+        self.assertIsInstance(data['coords'], str)
+
+    def test_optimized_route(self):
+        """Test the optimized route visits every located stop"""
+        response = self.api_client.get(f'/logistics/api/map/tournees/{self.tournee.id}/optimized-route/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(point['expedition_id'] for point in response.data['optimized_route']),
+            [self.expeditions[0].id, self.expeditions[1].id]
+        )
+        self.assertAlmostEqual(response.data['total_distance_km'], 392, delta=5)
+
+    def test_generate_expedition_map_html(self):
+        """Test the report map embeds one marker row per located expedition"""
+        from .map_views import generate_expedition_map_html
+
+        html = generate_expedition_map_html(force_refresh=True)
+        self.assertIn('EXP000200', html)
+        self.assertIn('EXP000201', html)
+        self.assertNotIn('EXP000202', html)
+
+
+class DeliveryNotificationTaskTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        client = Client.objects.create(
+            nom="Notif", prenom="Client", email="notif@test.com",
+            telephone="+33123456789", adresse="Notif Address"
+        )
+        destination = Destination.objects.create(
+            ville="Lyon", pays="France", zone_geographique="Europe", tarif_base=40.00
+        )
+        type_service = TypeService.objects.create(nom="Standard")
+        for i in range(3):
+            Expedition.objects.create(
+                numero=f"EXP00030{i}", client=client, type_service=type_service,
+                destination=destination, poids=10.0, volume=1.0, montant=50.00, statut='livraison'
+            )
+
+    def test_send_delivery_notifications(self):
+        """Test notifications go out in batches over one connection and a failed batch is skipped"""
+        from unittest import mock
+        from django.core import mail
+        from django.core.mail.backends.locmem import EmailBackend
+        from .tasks import send_delivery_notifications
+
+        send_messages = EmailBackend.send_messages
+        calls = []
+
+        def flaky_send_messages(backend, messages):
+            calls.append(backend)
+            if len(calls) == 2:
+                raise ConnectionError("SMTP connection lost")
+            return send_messages(backend, messages)
+
+        with mock.patch('apps.logistics.tasks.DELIVERY_NOTIFICATION_BATCH_SIZE', 1), \
+                mock.patch.object(EmailBackend, 'send_messages', flaky_send_messages):
+            result = send_delivery_notifications()
+
+        self.assertEqual(result, "Sent 2 delivery notifications")
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len({id(backend) for backend in calls}), 1)
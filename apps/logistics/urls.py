@@ -2,6 +2,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .api_views import ExpeditionViewSet, TourneeViewSet, TrackingLogViewSet
+from .map_views import ClusterView, ExpeditionMapView, HeatMapView, RouteOptimizationView, TourneeMapView
 
 router = DefaultRouter()
 router.register(r'expeditions', ExpeditionViewSet)
@@ -9,5 +10,10 @@ router.register(r'tournees', TourneeViewSet)
 router.register(r'tracking', TrackingLogViewSet)
 
 urlpatterns = [
+	path('api/map/expeditions/', ExpeditionMapView.as_view(), name='expedition-map'),
+	path('api/map/clusters/', ClusterView.as_view(), name='expedition-clusters'),
+	path('api/map/heatmap/', HeatMapView.as_view(), name='heat-map'),
+	path('api/map/tournees/<int:tournee_id>/', TourneeMapView.as_view(), name='tournee-map'),
+	path('api/map/tournees/<int:tournee_id>/optimized-route/', RouteOptimizationView.as_view(), name='tournee-optimized-route'),
 	path('api/', include(router.urls)),
 ]
\ No newline at end of file
@@ -3,10 +3,70 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.filters import SearchFilter, OrderingFilter
+import logging
+from django.core.cache import cache
+from django.db import connection
 from django.db.models import Count, Q
+from django.utils import timezone
 from .models import Incident, Reclamation
 from .serializers import IncidentSerializer, ReclamationSerializer
 
+logger = logging.getLogger(__name__)
+
+INCIDENT_STATS_CACHE_KEY = 'incident:stats:v1'
+INCIDENT_STATS_CACHE_TIMEOUT = 60
+
+# Columns rendered by IncidentSerializer, loaded on list pages instead of full joined rows
+INCIDENT_LIST_FIELDS = (
+    'id', 'type', 'severite', 'priorite', 'commentaire', 'date', 'document',
+    'resolution_details', 'date_resolution', 'created_at', 'updated_at', 'is_active',
+    'expedition__numero', 'tournee__date', 'tournee__chauffeur__nom', 'tournee__chauffeur__prenom',
+)
+
+# Valid values for ReclamationViewSet.update_status
+_STATUT_VALUES = frozenset(value for value, _ in Reclamation.STATUT_CHOICES)
+
+# Breakdown keys of the incident statistics, by grouped column
+INCIDENT_BREAKDOWNS = {'type': 'by_type', 'severite': 'by_severity', 'priorite': 'by_priority'}
+
+
+def _incident_statistics():
+    """Incident totals plus counts per type, severity and priority"""
+    stats = {breakdown: {} for breakdown in INCIDENT_BREAKDOWNS.values()}
+
+    if connection.vendor == 'postgresql':
+        # One scan: each grouping set fills one breakdown, the empty set gives the totals
+        opts = Incident._meta
+        qn = connection.ops.quote_name
+        columns = [qn(opts.get_field(field).column) for field in INCIDENT_BREAKDOWNS]
+        sets = ', '.join(f'({column})' for column in columns)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {', '.join(columns)}, COUNT(*), COUNT({qn(opts.get_field('date_resolution').column)}) "
+                f"FROM {qn(opts.db_table)} GROUP BY GROUPING SETS ({sets}, ())"
+            )
+            rows = cursor.fetchall()
+
+        stats.update(total_incidents=0, resolved_incidents=0, unresolved_incidents=0)
+        for *values, total, resolved in rows:
+            # The grouped columns are NOT NULL, so the non-null value names the grouping set
+            for breakdown, value in zip(INCIDENT_BREAKDOWNS.values(), values):
+                if value is not None:
+                    stats[breakdown][value] = total
+                    break
+            else:
+                stats.update(total_incidents=total, resolved_incidents=resolved, unresolved_incidents=total - resolved)
+        return stats
+
+    stats.update(Incident.objects.aggregate(
+        total_incidents=Count('id'),
+        resolved_incidents=Count('id', filter=Q(date_resolution__isnull=False)),
+        unresolved_incidents=Count('id', filter=Q(date_resolution__isnull=True))
+    ))
+    for field, breakdown in INCIDENT_BREAKDOWNS.items():
+        stats[breakdown] = dict(Incident.objects.order_by().values_list(field).annotate(count=Count('id')))
+    return stats
+
 class IsAuthenticatedOrReadOnly(permissions.BasePermission):
     def has_permission(self, request, view):
         if request.method in permissions.SAFE_METHODS:
@@ -14,7 +74,8 @@ class IsAuthenticatedOrReadOnly(permissions.BasePermission):
         return request.user.is_authenticated
 
 class IncidentViewSet(viewsets.ModelViewSet):
-    queryset = Incident.objects.select_related('expedition', 'tournee').order_by('-date')
+    # The serializer reads expedition.numero and tournee.chauffeur names on every row
+    queryset = Incident.objects.select_related('expedition', 'tournee__chauffeur').order_by('-date')
     serializer_class = IncidentSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
@@ -23,6 +84,13 @@ class IncidentViewSet(viewsets.ModelViewSet):
     ordering_fields = ['date', 'severite', 'priorite']
     ordering = ['-date']
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('list', 'unresolved'):
+            # The serializer only reads a few columns of the joined expedition, tour and driver
+            queryset = queryset.only(*INCIDENT_LIST_FIELDS)
+        return queryset
+
     @action(detail=True, methods=['post'])
     def resolve(self, request, pk=None):
         incident = self.get_object()
@@ -37,14 +105,11 @@ class IncidentViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['get'])
     def statistics(self, request):
-        stats = Incident.objects.aggregate(
-            total_incidents=Count('id'),
-            resolved_incidents=Count('id', filter=Q(date_resolution__isnull=False)),
-            unresolved_incidents=Count('id', filter=Q(date_resolution__isnull=True)),
-            by_type=Count('type'),
-            by_severity=Count('severite'),
-            by_priority=Count('priorite')
-        )
+        try:
+            stats = cache.get_or_set(INCIDENT_STATS_CACHE_KEY, _incident_statistics, timeout=INCIDENT_STATS_CACHE_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Incident statistics cache unavailable: {e}")
+            stats = _incident_statistics()
         return Response(stats)
 
     @action(detail=False, methods=['get'])
@@ -54,7 +119,10 @@ class IncidentViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
 class ReclamationViewSet(viewsets.ModelViewSet):
-    queryset = Reclamation.objects.select_related('client').prefetch_related('expeditions').order_by('-date')
+    # Expedition count computed in the list query instead of once per reclamation
+    queryset = Reclamation.objects.select_related('client').prefetch_related('expeditions').annotate(
+        expedition_count=Count('expeditions')
+    ).order_by('-date')
     serializer_class = ReclamationSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
@@ -67,11 +135,13 @@ class ReclamationViewSet(viewsets.ModelViewSet):
     def update_status(self, request, pk=None):
         reclamation = self.get_object()
         new_status = request.data.get('statut')
-        if new_status not in dict(Reclamation.STATUT_CHOICES):
+        if new_status not in _STATUT_VALUES:
             return Response({'error': 'Invalid status'}, status=status.HTTP_400_BAD_REQUEST)
 
+        # Only the status changes, so skip the full-row save
         reclamation.statut = new_status
-        reclamation.save()
+        reclamation.updated_at = timezone.now()
+        Reclamation.objects.filter(pk=reclamation.pk).update(statut=new_status, updated_at=reclamation.updated_at)
         serializer = self.get_serializer(reclamation)
         return Response(serializer.data)
 
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-15 23:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+        ('logistics', '0011_expedition_map_indexes'),
+        ('support', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='incident',
+            index=models.Index(condition=models.Q(('date_resolution__isnull', True)), fields=['-date'], name='incident_unresolved_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reclamation',
+            index=models.Index(condition=models.Q(('statut', 'en_cours')), fields=['-date'], name='reclamation_pending_idx'),
+        ),
+    ]
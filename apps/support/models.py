@@ -45,6 +45,7 @@ class Incident(models.Model):
 			models.Index(fields=['severite']),
 			models.Index(fields=['priorite']),
 			models.Index(fields=['date']),
+			models.Index(fields=['-date'], name='incident_unresolved_idx', condition=models.Q(date_resolution__isnull=True)),
 		]
 		ordering = ['-date']
 
@@ -73,6 +74,7 @@ class Reclamation(models.Model):
 			models.Index(fields=['client']),
 			models.Index(fields=['statut']),
 			models.Index(fields=['date']),
+			models.Index(fields=['-date'], name='reclamation_pending_idx', condition=models.Q(statut='en_cours')),
 		]
 		ordering = ['-date']
 
@@ -23,4 +23,7 @@ class ReclamationSerializer(serializers.ModelSerializer):
         read_only_fields = ['date', 'created_at', 'updated_at']
 
     def get_expedition_count(self, obj):
+        # Use the count annotated by ReclamationViewSet when present
+        if hasattr(obj, 'expedition_count'):
+            return obj.expedition_count
         return obj.expeditions.count()
@@ -5,6 +5,7 @@ from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.filters import SearchFilter, OrderingFilter
 from django.contrib.auth import authenticate
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
@@ -14,6 +15,27 @@ from django.contrib.auth.tokens import default_token_generator
 from django.conf import settings
 from .models import User, UserFavorites, AuditLog
 from .serializers import UserSerializer, LoginSerializer, UserFavoritesSerializer, AuditLogSerializer
+from .tasks import log_login
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def schedule_login_log(request, user, username, status):
+    """Queue the login history row so the login response does not wait on the INSERT"""
+    args = (
+        user.pk if user else None,
+        username,
+        status,
+        getattr(request, '_audit_ip', None),
+        getattr(request, '_audit_user_agent', '')
+    )
+    try:
+        log_login.delay(*args)
+    except Exception as e:
+        # Broker unavailable: keep the login trail by writing it inline
+        logger.error(f"Failed to queue login history for {username}: {e}")
+        log_login(*args)
 
 class IsAdminOrSelf(permissions.BasePermission):
     """
@@ -53,7 +75,7 @@ class UserViewSet(viewsets.ModelViewSet):
 
         if user.role == 'agent':
             # Agents can only see other agents and themselves
-            return queryset.filter(role__in=['agent', 'chauffeur']) | queryset.filter(id=user.id)
+            return queryset.filter(Q(role__in=['agent', 'chauffeur']) | Q(id=user.id))
         elif user.role == 'chauffeur':
             # Chauffeurs can only see themselves
             return queryset.filter(id=user.id)
@@ -71,13 +93,7 @@ class UserViewSet(viewsets.ModelViewSet):
             user = authenticate(username=username, password=password)
             if user:
                 # Log successful login
-                LoginHistory.objects.create(
-                    user=user,
-                    username_attempted=username,
-                    status='success',
-                    ip_address=getattr(request, '_audit_ip', None),
-                    user_agent=getattr(request, '_audit_user_agent', '')
-                )
+                schedule_login_log(request, user, username, 'success')
                 refresh = RefreshToken.for_user(user)
                 return Response({
                     'refresh': str(refresh),
@@ -86,13 +102,7 @@ class UserViewSet(viewsets.ModelViewSet):
                 })
             else:
                 # Log failed login
-                LoginHistory.objects.create(
-                    user=None,
-                    username_attempted=username,
-                    status='failed',
-                    ip_address=getattr(request, '_audit_ip', None),
-                    user_agent=getattr(request, '_audit_user_agent', '')
-                )
+                schedule_login_log(request, None, username, 'failed')
                 return Response({'error': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -191,7 +201,10 @@ class UserFavoritesViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         # Users can only see their own favorites
-        return UserFavorites.objects.filter(user=self.request.user)
+        # The serializer reads content_type.model and str(content_object) for each favorite
+        return UserFavorites.objects.filter(user=self.request.user).select_related(
+            'content_type'
+        ).prefetch_related('content_object')
     
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -207,8 +220,9 @@ class UserFavoritesViewSet(viewsets.ModelViewSet):
                           status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            content_type = ContentType.objects.get(id=content_type_id)
-        except ContentType.DoesNotExist:
+            # Served from the ContentType cache (keyed by integer id) after the first lookup
+            content_type = ContentType.objects.get_for_id(int(content_type_id))
+        except (ContentType.DoesNotExist, ValueError):
             return Response({'error': 'Invalid content_type'}, status=status.HTTP_400_BAD_REQUEST)
         
         favorite, created = UserFavorites.objects.get_or_create(
@@ -256,7 +270,8 @@ class AuditLogViewSet(viewsets.ReadOnlyModelViewSet):
     
     def get_queryset(self):
         # Admins can see all logs, others only their own
+        queryset = AuditLog.objects.select_related('user', 'content_type')
         if self.request.user.role == 'admin':
-            return AuditLog.objects.all()
-        return AuditLog.objects.filter(user=self.request.user)
+            return queryset
+        return queryset.filter(user=self.request.user)
 
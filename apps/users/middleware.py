@@ -2,11 +2,18 @@
 Middleware for automatic audit logging of all model changes
 """
 import json
+import logging
+from django.apps import apps
 from django.utils.deprecation import MiddlewareMixin
 from django.contrib.contenttypes.models import ContentType
 from django.core.serializers.json import DjangoJSONEncoder
 from apps.users.models import AuditLog
 
+logger = logging.getLogger(__name__)
+
+# Audit entries written per INSERT when a request's buffer is flushed
+AUDIT_BATCH_SIZE = 1000
+
 
 class AuditLogMiddleware(MiddlewareMixin):
     """Middleware to automatically log all database operations"""
@@ -15,7 +22,32 @@ class AuditLogMiddleware(MiddlewareMixin):
         # Store request info for later use in signals
         request._audit_ip = self.get_client_ip(request)
         request._audit_user_agent = request.META.get('HTTP_USER_AGENT', '')[:500]
+        # Entries logged during the request, written together in process_response
+        request._audit_buffer = []
         return None
+
+    def process_response(self, request, response):
+        buffer = getattr(request, '_audit_buffer', None)
+        if buffer:
+            try:
+                AuditLog.objects.bulk_create(buffer, batch_size=AUDIT_BATCH_SIZE)
+            except Exception:
+                logger.exception("Bulk write of %d audit log entries failed, saving them one by one", len(buffer))
+                self.save_entries(buffer)
+            buffer.clear()
+        return response
+
+    @staticmethod
+    def save_entries(entries):
+        """Save audit entries individually so one bad row does not lose the others"""
+        for entry in entries:
+            try:
+                entry.save(force_insert=True)
+            except Exception:
+                logger.exception(
+                    "Failed to write audit log entry: %s %s by user %s",
+                    entry.action, entry.object_repr, entry.user_id
+                )
     
     @staticmethod
     def get_client_ip(request):
@@ -28,6 +60,20 @@ class AuditLogMiddleware(MiddlewareMixin):
         return ip
 
 
+_content_types_loaded = False
+
+
+def load_content_types():
+    """
+    Fill the ContentType cache for every installed model with a single query,
+    instead of one query per model the first time each one is logged
+    """
+    global _content_types_loaded
+    if not _content_types_loaded:
+        ContentType.objects.get_for_models(*apps.get_models())
+        _content_types_loaded = True
+
+
 def log_action(user, action, obj, changes=None, request=None):
     """
     Helper function to log an action
@@ -49,6 +95,7 @@ def log_action(user, action, obj, changes=None, request=None):
     except TypeError:
         serializable_changes = {"detail": str(serializable_changes)}
 
+    load_content_types()
     content_type = ContentType.objects.get_for_model(obj)
 
     audit_data = {
@@ -63,5 +110,11 @@ def log_action(user, action, obj, changes=None, request=None):
     if request:
         audit_data['ip_address'] = getattr(request, '_audit_ip', None)
         audit_data['user_agent'] = getattr(request, '_audit_user_agent', '')
-    
+
+        buffer = getattr(request, '_audit_buffer', None)
+        if buffer is not None:
+            # Flushed by AuditLogMiddleware.process_response
+            buffer.append(AuditLog(**audit_data))
+            return
+
     AuditLog.objects.create(**audit_data)
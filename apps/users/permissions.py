@@ -1,6 +1,20 @@
 from rest_framework import permissions
 
 
+def user_has_perm(request, perm):
+    """
+    Vérifie une permission sur l'ensemble des permissions de l'utilisateur, chargé une seule fois par requête
+    """
+    user = request.user
+    if user.is_active and user.is_superuser:
+        return True
+    perm_set = getattr(request, '_perm_set', None)
+    if perm_set is None:
+        perm_set = frozenset(user.get_all_permissions()) if user.is_authenticated else frozenset()
+        request._perm_set = perm_set
+    return perm in perm_set
+
+
 class IsAgent(permissions.BasePermission):
     """
     Permission pour les agents de transport
@@ -20,20 +20,26 @@ class UserSerializer(serializers.ModelSerializer):
         return f"{obj.first_name} {obj.last_name}".strip()
 
     def create(self, validated_data):
+        # Hash the password before the first save so the user is written in one INSERT
         password = validated_data.pop('password', None)
-        user = super().create(validated_data)
+        user = User(**validated_data)
         if password:
             user.set_password(password)
-            user.save()
+        user.save()
         return user
 
     def update(self, instance, validated_data):
+        # Apply the fields and the new password, then write them in one UPDATE
         password = validated_data.pop('password', None)
-        user = super().update(instance, validated_data)
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        update_fields = list(validated_data)
         if password:
-            user.set_password(password)
-            user.save()
-        return user
+            instance.set_password(password)
+            update_fields.append('password')
+        if update_fields:
+            instance.save(update_fields=update_fields + ['updated_at'])
+        return instance
 
 class LoginSerializer(serializers.Serializer):
     username = serializers.CharField(required=True)
@@ -0,0 +1,16 @@
+from celery import shared_task
+from .models import LoginHistory
+
+
+@shared_task
+def log_login(user_id, username, status, ip_address, user_agent):
+    """
+    Record a login attempt outside of the login request
+    """
+    LoginHistory.objects.create(
+        user_id=user_id,
+        username_attempted=username,
+        status=status,
+        ip_address=ip_address,
+        user_agent=user_agent
+    )
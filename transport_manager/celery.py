@@ -33,4 +33,12 @@ app.conf.beat_schedule = {
         'task': 'apps.logistics.tasks.update_shipment_statuses',
         'schedule': crontab(minute='*/30'),  # Every 30 minutes
     },
+    'refresh-monthly-dashboard-rollup': {
+        'task': 'apps.dashboard.tasks.refresh_monthly_rollup',
+        'schedule': crontab(hour=0, minute=5),  # Every day at 00:05
+    },
+    'refresh-expedition-time-in-status': {
+        'task': 'apps.logistics.tasks.refresh_status_view',
+        'schedule': crontab(minute='*/5'),  # Every 5 minutes
+    },
 }
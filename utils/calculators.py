@@ -1,6 +1,36 @@
+import time
 from decimal import Decimal
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from apps.core.models import Tarification, Destination
 
+# Active tariffs keyed by (type_service_id, destination_id), reloaded after TARIFF_MATRIX_TTL seconds
+# so that other worker processes pick up changes made elsewhere
+TARIFF_MATRIX_TTL = 300
+_tariff_matrix = None
+_tariff_matrix_loaded_at = 0.0
+
+def get_tariff_matrix():
+    """
+    Return the {(type_service_id, destination_id): (tarif_poids, tarif_volume)} matrix of active tariffs.
+    """
+    global _tariff_matrix, _tariff_matrix_loaded_at
+    if _tariff_matrix is None or time.monotonic() - _tariff_matrix_loaded_at > TARIFF_MATRIX_TTL:
+        _tariff_matrix = {
+            (type_service_id, destination_id): (tarif_poids, tarif_volume)
+            for type_service_id, destination_id, tarif_poids, tarif_volume in Tarification.objects.filter(
+                is_active=True
+            ).values_list('type_service_id', 'destination_id', 'tarif_poids', 'tarif_volume')
+        }
+        _tariff_matrix_loaded_at = time.monotonic()
+    return _tariff_matrix
+
+@receiver([post_save, post_delete], sender=Tarification)
+def clear_tariff_matrix(**kwargs):
+    """Drop the cached tariff matrix when a tariff changes"""
+    global _tariff_matrix
+    _tariff_matrix = None
+
 def calculate_shipping_cost(type_service, destination, weight, volume):
     """
     Calculate the total shipping cost based on service type, destination, weight, and volume.
@@ -14,24 +44,19 @@ def calculate_shipping_cost(type_service, destination, weight, volume):
     Returns:
         Decimal: Total cost including base tariff and weight/volume rates
     """
-    try:
-        tarification = Tarification.objects.get(
-            type_service=type_service,
-            destination=destination,
-            is_active=True
-        )
-
-        # Calculate cost: base tariff + (weight * rate per kg) + (volume * rate per m3)
-        base_cost = destination.tarif_base
-        weight_cost = weight * tarification.tarif_poids
-        volume_cost = volume * tarification.tarif_volume
+    rates = get_tariff_matrix().get((type_service.pk, destination.pk))
+    if rates is None:
+        raise ValueError(f"No pricing found for {type_service} to {destination}")
+    tarif_poids, tarif_volume = rates
 
-        total_cost = base_cost + weight_cost + volume_cost
+    # Calculate cost: base tariff + (weight * rate per kg) + (volume * rate per m3)
+    base_cost = destination.tarif_base
+    weight_cost = weight * tarif_poids
+    volume_cost = volume * tarif_volume
 
-        return total_cost.quantize(Decimal('0.01'))  # Round to 2 decimal places
+    total_cost = base_cost + weight_cost + volume_cost
 
-    except Tarification.DoesNotExist:
-        raise ValueError(f"No pricing found for {type_service} to {destination}")
+    return total_cost.quantize(Decimal('0.01'))  # Round to 2 decimal places
 
 def calculate_tva(amount, tva_rate=0.19):
     """
@@ -73,3 +98,27 @@ def calculate_fuel_consumption(distance, consumption_rate):
         Decimal: Fuel consumption in liters
     """
     return ((distance * consumption_rate) / 100).quantize(Decimal('0.01'))
+
+# Operating cost rates of a tour
+FUEL_PRICE_PER_LITER = Decimal('1.50')
+DRIVER_COST_PER_KM = Decimal('0.50')
+MAINTENANCE_COST_PER_KM = Decimal('0.20')
+
+def calculate_tournee_cost(distance, fuel_liters):
+    """
+    Calculate the operating cost of a tour.
+
+    Args:
+        distance: Decimal - distance in km
+        fuel_liters: Decimal - fuel used in liters
+
+    Returns:
+        dict: fuel_cost, driver_cost, maintenance_cost and total_cost
+    """
+    costs = {
+        'fuel_cost': (fuel_liters * FUEL_PRICE_PER_LITER).quantize(Decimal('0.01')),
+        'driver_cost': (distance * DRIVER_COST_PER_KM).quantize(Decimal('0.01')),
+        'maintenance_cost': (distance * MAINTENANCE_COST_PER_KM).quantize(Decimal('0.01')),
+    }
+    costs['total_cost'] = sum(costs.values())
+    return costs
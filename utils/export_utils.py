@@ -27,8 +27,8 @@ class ExportMixin:
         headers = [field.replace('_', ' ').title() for field in fields]
         writer.writerow(headers)
         
-        # Write data
-        for obj in queryset:
+        # Write data, streaming rows instead of caching the whole queryset
+        for obj in queryset.iterator(chunk_size=2000):
             row = []
             for field in fields:
                 value = getattr(obj, field, '')
@@ -0,0 +1,89 @@
+"""
+Compact binary renderers for coordinate-heavy API payloads
+"""
+import base64
+import datetime
+import decimal
+
+import msgpack
+import orjson
+from rest_framework.renderers import BaseRenderer
+
+
+def _encode_default(obj):
+    """Encode the values DRF's JSON encoder would otherwise handle"""
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    raise TypeError(f"Cannot serialize {type(obj).__name__}")
+
+
+class ORJSONRenderer(BaseRenderer):
+    """
+    Render JSON with orjson, which encodes floats and NumPy arrays natively and much faster than the stdlib encoder
+    """
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return orjson.dumps(data, default=_encode_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Render responses as MessagePack for clients sending Accept: application/x-msgpack
+
+    Decode on the client with msgpack.decode(new Uint8Array(await response.arrayBuffer()))
+    """
+    media_type = 'application/x-msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=_encode_default, use_bin_type=True)
+
+
+def _write_varint(buffer, value):
+    """Append a zig-zag varint encoding of a signed integer"""
+    value = value << 1 if value >= 0 else (-value << 1) - 1
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def pack_coords(latlngs, precision=6):
+    """
+    Encode [lat, lng] pairs as base64 zig-zag varint deltas of coordinates quantized to 10**-precision degrees
+
+    Client-side decoder:
+        function unpackCoords(b64, precision) {
+            var bytes = Uint8Array.from(atob(b64), function (c) { return c.charCodeAt(0); });
+            var scale = Math.pow(10, precision), prev = [0, 0], coords = [], point = [], i = 0;
+            while (i < bytes.length) {
+                var value = 0, shift = 0, b;
+                do { b = bytes[i++]; value += (b & 0x7f) * Math.pow(2, shift); shift += 7; } while (b & 0x80);
+                var k = point.length;
+                prev[k] += value % 2 ? -(value + 1) / 2 : value / 2;
+                point.push(prev[k] / scale);
+                if (point.length === 2) { coords.push(point); point = []; }
+            }
+            return coords;
+        }
+    """
+    scale = 10 ** precision
+    buffer = bytearray()
+    prev_lat = prev_lng = 0
+    for lat, lng in latlngs:
+        lat, lng = round(float(lat) * scale), round(float(lng) * scale)
+        _write_varint(buffer, lat - prev_lat)
+        _write_varint(buffer, lng - prev_lng)
+        prev_lat, prev_lng = lat, lng
+    return base64.b64encode(bytes(buffer)).decode('ascii')